@@ -413,7 +413,8 @@ def exec_func_shell(func, d, runfile, cwd=None):
     """
 
     # Don't let the emitted shell script override PWD
-    d.delVarFlag('PWD', 'export')
+    if d.getVarFlag('PWD', 'export', False):
+        d.delVarFlag('PWD', 'export')
 
     with open(runfile, 'w') as script:
         script.write(shell_trap_code())
@@ -19,6 +19,9 @@
 import os
 import logging
 import pickle
+import struct
+import tempfile
+import zlib
 from collections import defaultdict
 from collections.abc import Mapping
 import bb.utils
@@ -947,6 +950,200 @@ class MultiProcessCache(object):
         bb.utils.unlockfile(glf)
 
 
+class AppendLogCache(object):
+    """
+    BitBake append-only multi-process cache implementation
+
+    Entries are keyed by hash and stored in a single log file shared by
+    all processes. Each new entry is appended with one O_APPEND write, and
+    a lookup miss picks up whatever other processes appended in the
+    meantime without taking the lock. Appends hold the lock so that they
+    can't race with compact(), which rewrites the log once duplicate or
+    unreadable records have built up.
+
+    Used by the codeparser cache
+    """
+
+    magic = b"BBLOG\x00\x00\x01"
+    header = struct.Struct("<8sI")
+    record = struct.Struct("<II")
+
+    def __init__(self):
+        self.cachefile = None
+        self.fd = None
+        self.inode = None
+        self.offset = 0
+        self.records = 0
+        self.corrupt = False
+        self.cachedata = self.create_cachedata()
+
+    def create_cachedata(self):
+        data = [{}]
+        return data
+
+    def init_cache(self, d, cache_file_name=None):
+        cachedir = (d.getVar("PERSISTENT_DIR") or
+                    d.getVar("CACHE"))
+        if cachedir in [None, '']:
+            return
+        bb.utils.mkdirhier(cachedir)
+        cachefile = os.path.join(cachedir,
+                                 cache_file_name or self.__class__.cache_file_name)
+        if self.fd is not None and cachefile == self.cachefile:
+            return
+        self.cachefile = cachefile
+        logger.debug("Using cache in '%s'", self.cachefile)
+
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            self.open_log()
+        finally:
+            bb.utils.unlockfile(glf)
+
+    def open_log(self):
+        self.close()
+        self.cachedata = self.create_cachedata()
+        self.records = 0
+        self.corrupt = False
+
+        fd = None
+        try:
+            fd = os.open(self.cachefile, os.O_RDWR | os.O_APPEND)
+            header = os.pread(fd, self.header.size, 0)
+            if len(header) != self.header.size or \
+                    self.header.unpack(header) != (self.magic, self.__class__.CACHE_VERSION):
+                os.close(fd)
+                fd = None
+        except FileNotFoundError:
+            pass
+
+        if fd is None:
+            # Missing, stale or from an older version, start with an empty log
+            self.write_log([])
+            fd = os.open(self.cachefile, os.O_RDWR | os.O_APPEND)
+
+        self.fd = fd
+        self.inode = os.fstat(fd).st_ino
+        self.offset = self.header.size
+        self.sync()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def write_log(self, records):
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.cachefile),
+                                       prefix=os.path.basename(self.cachefile) + ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.header.pack(self.magic, self.__class__.CACHE_VERSION))
+                for payload in records:
+                    f.write(self.record.pack(len(payload), zlib.crc32(payload)))
+                    f.write(payload)
+            os.replace(tmpname, self.cachefile)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def sync(self, locked=False):
+        """
+        Load the records appended to the log since the last call. With the
+        lock held no append can be in progress, so an incomplete record at
+        the end of the log is damaged rather than still being written.
+        """
+        if self.fd is None:
+            return
+
+        try:
+            st = os.stat(self.cachefile)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != self.inode:
+            # The log was compacted or removed under us
+            self.open_log()
+            return
+
+        if st.st_size <= self.offset:
+            return
+
+        data = os.pread(self.fd, st.st_size - self.offset, self.offset)
+        pos = 0
+        while pos + self.record.size <= len(data):
+            length, crc = self.record.unpack_from(data, pos)
+            end = pos + self.record.size + length
+            payload = data[pos + self.record.size:end]
+            try:
+                if end > len(data):
+                    if not locked:
+                        # Still being written, pick it up next time
+                        break
+                    raise ValueError("truncated record")
+                if zlib.crc32(payload) != crc:
+                    raise ValueError("checksum mismatch")
+                index, key, value = pickle.loads(payload)
+                self.cachedata[index][key] = value
+            except Exception as e:
+                # Record boundaries can no longer be trusted, skip to the
+                # end and leave it to compact() to rewrite the log
+                logger.debug("Ignoring damaged cache log '%s': %s", self.cachefile, e)
+                self.corrupt = True
+                pos = len(data)
+                break
+            self.records += 1
+            pos = end
+        self.offset += pos
+
+    def get(self, index, key):
+        try:
+            return self.cachedata[index][key]
+        except KeyError:
+            pass
+        self.sync()
+        return self.cachedata[index].get(key)
+
+    def append(self, index, key, value):
+        if self.fd is not None:
+            payload = pickle.dumps((index, key, value), -1)
+            glf = bb.utils.lockfile(self.cachefile + ".lock")
+            try:
+                # Follow a compaction first, a record written to the
+                # replaced log would be lost
+                self.sync(locked=True)
+                os.write(self.fd, self.record.pack(len(payload), zlib.crc32(payload)) + payload)
+            except OSError as e:
+                logger.debug("Unable to append to cache log '%s': %s", self.cachefile, e)
+                self.close()
+            finally:
+                bb.utils.unlockfile(glf)
+        self.cachedata[index][key] = value
+
+    def compact(self, force=False):
+        """
+        Rewrite the log without duplicate or damaged records, if it has
+        accumulated enough of them to be worth it
+        """
+        if self.fd is None:
+            return
+
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            self.sync(locked=True)
+            entries = sum(len(c) for c in self.cachedata)
+            if not force and not self.corrupt and self.records <= 2 * entries:
+                return
+            logger.debug("Compacting cache log '%s' (%d records, %d entries)",
+                         self.cachefile, self.records, entries)
+            records = []
+            for index, cache in enumerate(self.cachedata):
+                for key, value in cache.items():
+                    records.append(pickle.dumps((index, key, value), -1))
+            self.write_log(records)
+            self.open_log()
+        finally:
+            bb.utils.unlockfile(glf)
+
+
 class SimpleCache(object):
     """
     BitBake multi-process cache implementation
@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import concurrent.futures
 import glob
 import operator
 import os
@@ -43,50 +44,104 @@ class FileMtimeCache(object):
     def clear(self):
         self.cache.clear()
 
-# Checksum + mtime cache (persistent)
+# stat cache (non-persistent)
+# based upon the same assumption as FileMtimeCache
+class FileStatCache(object):
+    cache = {}
+
+    def cached_stat(self, f):
+        if f not in self.cache:
+            self.cache[f] = os.stat(f)
+        return self.cache[f]
+
+    def clear(self):
+        self.cache.clear()
+
+# Checksum cache keyed on path, validated against the file identity (persistent)
 class FileChecksumCache(MultiProcessCache):
     cache_file_name = "local_file_checksum_cache.dat"
-    CACHE_VERSION = 1
+    CACHE_VERSION = 3
+
+    # Files are hashed on a thread pool, hashlib drops the GIL while
+    # digesting so this scales with the number of cores
+    threads = min(8, os.cpu_count() or 1)
 
     def __init__(self):
-        self.mtime_cache = FileMtimeCache()
+        self.stat_cache = FileStatCache()
         MultiProcessCache.__init__(self)
 
-    def get_checksum(self, f):
-        f = os.path.normpath(f)
-        entry = self.cachedata[0].get(f)
-        cmtime = self.mtime_cache.cached_mtime(f)
+    def file_identity(self, f):
+        st = self.stat_cache.cached_stat(f)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, f, identity):
+        entry = self.cachedata_extras[0].get(f) or self.cachedata[0].get(f)
         if entry:
-            (mtime, hashval) = entry
-            if cmtime == mtime:
+            (cidentity, hashval) = entry
+            if cidentity == identity:
                 return hashval
-            else:
-                bb.debug(2, "file %s changed mtime, recompute checksum" % f)
+            bb.debug(2, "file %s changed, recompute checksum" % f)
+        return None
 
-        hashval = bb.utils.md5_file(f)
-        self.cachedata_extras[0][f] = (cmtime, hashval)
+    def get_checksum(self, f):
+        f = os.path.normpath(f)
+        identity = self.file_identity(f)
+        hashval = self.lookup(f, identity)
+        if hashval is None:
+            hashval = bb.utils.md5_file(f)
+            self.cachedata_extras[0][f] = (identity, hashval)
         return hashval
 
     def merge_data(self, source, dest):
+        # Entries are only added for files whose cached identity didn't
+        # match, so the new one replaces the stale one
         for h in source[0]:
-            if h in dest:
-                (smtime, _) = source[0][h]
-                (dmtime, _) = dest[0][h]
-                if smtime > dmtime:
-                    dest[0][h] = source[0][h]
+            dest[0][h] = source[0][h]
+
+    def get_checksums_batch(self, files):
+        """
+        Get checksums for a list of files, hashing the ones missing from
+        the cache in parallel. Files reached through several paths
+        (hardlinks, bind mounts) are only hashed once. Returns a list of
+        (file, checksum or exception) in the order given.
+        """
+        results = {}
+        missing = {}
+        for f in files:
+            path = os.path.normpath(f)
+            try:
+                identity = self.file_identity(path)
+            except OSError as e:
+                results[f] = e
+                continue
+            hashval = self.lookup(path, identity)
+            if hashval is not None:
+                results[f] = hashval
             else:
-                dest[0][h] = source[0][h]
-
-    def get_checksums(self, filelist, pn, localdirsexclude):
-        """Get checksums for a list of files"""
+                missing.setdefault(identity, []).append(f)
 
-        def checksum_file(f):
+        def hash_file(key):
             try:
-                checksum = self.get_checksum(f)
+                return bb.utils.md5_file(missing[key][0])
             except OSError as e:
-                bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
-                return None
-            return checksum
+                return e
+
+        if len(missing) > 1 and self.threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+                hashvals = list(executor.map(hash_file, missing))
+        else:
+            hashvals = map(hash_file, missing)
+
+        for key, hashval in zip(list(missing), hashvals):
+            for f in missing[key]:
+                if not isinstance(hashval, OSError):
+                    self.cachedata_extras[0][os.path.normpath(f)] = (key, hashval)
+                results[f] = hashval
+
+        return [(f, results[f]) for f in files]
+
+    def get_checksums(self, filelist, pn, localdirsexclude):
+        """Get checksums for a list of files"""
 
         #
         # Changing the format of file-checksums is problematic as both OE and Bitbake have
@@ -96,22 +151,18 @@ class FileChecksumCache(MultiProcessCache):
         # the path. The filesystem handles it but it gives us a marker to know which subsection
         # of the path to cache.
         #
-        def checksum_dir(pth):
+        def walk_dir(pth):
             # Handle directories recursively
             if pth == "/":
                 bb.fatal("Refusing to checksum /")
             pth = pth.rstrip("/")
-            dirchecksums = []
             for root, dirs, files in os.walk(pth, topdown=True):
                 [dirs.remove(d) for d in list(dirs) if d in localdirsexclude]
                 for name in files:
-                    fullpth = os.path.join(root, name).replace(pth, os.path.join(pth, "."))
-                    checksum = checksum_file(fullpth)
-                    if checksum:
-                        dirchecksums.append((fullpth, checksum))
-            return dirchecksums
+                    yield os.path.join(root, name).replace(pth, os.path.join(pth, "."))
 
-        checksums = []
+        # Collect every file first so that whole trees are hashed in one batch
+        files = []
         for pth in filelist_regex.split(filelist):
             if not pth:
                 continue
@@ -127,18 +178,21 @@ class FileChecksumCache(MultiProcessCache):
                 for f in glob.glob(pth):
                     if os.path.isdir(f):
                         if not os.path.islink(f):
-                            checksums.extend(checksum_dir(f))
+                            files.extend(walk_dir(f))
                     else:
-                        checksum = checksum_file(f)
-                        if checksum:
-                            checksums.append((f, checksum))
+                        files.append(f)
             elif os.path.isdir(pth):
                 if not os.path.islink(pth):
-                    checksums.extend(checksum_dir(pth))
+                    files.extend(walk_dir(pth))
             else:
-                checksum = checksum_file(pth)
-                if checksum:
-                    checksums.append((pth, checksum))
+                files.append(pth)
+
+        checksums = []
+        for f, checksum in self.get_checksums_batch(files):
+            if isinstance(checksum, OSError):
+                bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), checksum))
+                continue
+            checksums.append((f, checksum))
 
         checksums.sort(key=operator.itemgetter(1))
         return checksums
@@ -32,7 +32,7 @@ import bb.utils, bb.data
 import hashlib
 from itertools import chain
 from bb.pysh import pyshyacc, pyshlex
-from bb.cache import MultiProcessCache
+from bb.cache import AppendLogCache
 
 logger = logging.getLogger('BitBake.CodeParser')
 
@@ -118,20 +118,20 @@ class shellCacheLine(object):
     def __repr__(self):
         return str(self.execs)
 
-class CodeParserCache(MultiProcessCache):
-    cache_file_name = "bb_codeparser.dat"
+class CodeParserCache(AppendLogCache):
+    cache_file_name = "bb_codeparser.log"
     # NOTE: you must increment this if you change how the parsers gather information,
     # so that an existing cache gets invalidated. Additionally you'll need
     # to increment __cache_version__ in cache.py in order to ensure that old
     # recipe caches don't trigger "Taskhash mismatch" errors.
     CACHE_VERSION = 11
 
+    # Indexes into cachedata
+    PYTHON = 0
+    SHELL = 1
+
     def __init__(self):
-        MultiProcessCache.__init__(self)
-        self.pythoncache = self.cachedata[0]
-        self.shellcache = self.cachedata[1]
-        self.pythoncacheextras = self.cachedata_extras[0]
-        self.shellcacheextras = self.cachedata_extras[1]
+        AppendLogCache.__init__(self)
 
         # To avoid duplication in the codeparser cache, keep
         # a lookup of hashes of objects we already have
@@ -154,17 +154,6 @@ class CodeParserCache(MultiProcessCache):
         self.shellcachelines[h] = cacheline
         return cacheline
 
-    def init_cache(self, d):
-        # Check if we already have the caches
-        if self.pythoncache:
-            return
-
-        MultiProcessCache.init_cache(self, d)
-
-        # cachedata gets re-assigned in the parent
-        self.pythoncache = self.cachedata[0]
-        self.shellcache = self.cachedata[1]
-
     def create_cachedata(self):
         data = [{}, {}]
         return data
@@ -174,11 +163,8 @@ codeparsercache = CodeParserCache()
 def parser_cache_init(d):
     codeparsercache.init_cache(d)
 
-def parser_cache_save():
-    codeparsercache.save_extras()
-
-def parser_cache_savemerge():
-    codeparsercache.save_merge()
+def parser_cache_compact():
+    codeparsercache.compact()
 
 Logger = logging.getLoggerClass()
 class BufferedLogger(Logger):
@@ -295,20 +281,13 @@ class PythonParser():
 
         h = bbhash(str(node))
 
-        if h in codeparsercache.pythoncache:
-            self.references = set(codeparsercache.pythoncache[h].refs)
-            self.execs = set(codeparsercache.pythoncache[h].execs)
+        cacheline = codeparsercache.get(codeparsercache.PYTHON, h)
+        if cacheline is not None:
+            self.references = set(cacheline.refs)
+            self.execs = set(cacheline.execs)
             self.contains = {}
-            for i in codeparsercache.pythoncache[h].contains:
-                self.contains[i] = set(codeparsercache.pythoncache[h].contains[i])
-            return
-
-        if h in codeparsercache.pythoncacheextras:
-            self.references = set(codeparsercache.pythoncacheextras[h].refs)
-            self.execs = set(codeparsercache.pythoncacheextras[h].execs)
-            self.contains = {}
-            for i in codeparsercache.pythoncacheextras[h].contains:
-                self.contains[i] = set(codeparsercache.pythoncacheextras[h].contains[i])
+            for i in cacheline.contains:
+                self.contains[i] = set(cacheline.contains[i])
             return
 
         # Need to parse so take the hit on the real log buffer
@@ -325,7 +304,7 @@ class PythonParser():
 
         self.execs.update(self.var_execs)
 
-        codeparsercache.pythoncacheextras[h] = codeparsercache.newPythonCacheLine(self.references, self.execs, self.contains)
+        codeparsercache.append(codeparsercache.PYTHON, h, codeparsercache.newPythonCacheLine(self.references, self.execs, self.contains))
 
 class ShellParser():
     def __init__(self, name, log):
@@ -347,12 +326,9 @@ class ShellParser():
 
         h = bbhash(str(value))
 
-        if h in codeparsercache.shellcache:
-            self.execs = set(codeparsercache.shellcache[h].execs)
-            return self.execs
-
-        if h in codeparsercache.shellcacheextras:
-            self.execs = set(codeparsercache.shellcacheextras[h].execs)
+        cacheline = codeparsercache.get(codeparsercache.SHELL, h)
+        if cacheline is not None:
+            self.execs = set(cacheline.execs)
             return self.execs
 
         # Need to parse so take the hit on the real log buffer
@@ -361,7 +337,7 @@ class ShellParser():
         self._parse_shell(value)
         self.execs = set(cmd for cmd in self.allexecs if cmd not in self.funcdefs)
 
-        codeparsercache.shellcacheextras[h] = codeparsercache.newShellCacheLine(self.execs)
+        codeparsercache.append(codeparsercache.SHELL, h, codeparsercache.newShellCacheLine(self.execs))
 
         return self.execs
 
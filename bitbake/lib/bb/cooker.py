@@ -1343,10 +1343,10 @@ class BBCooker:
         file associated with a recipe might have been modified by the user).
         """
         build.reset_cache()
-        bb.fetch._checksum_cache.mtime_cache.clear()
+        bb.fetch._checksum_cache.stat_cache.clear()
         siggen_cache = getattr(bb.parse.siggen, 'checksum_cache', None)
         if siggen_cache:
-            bb.parse.siggen.checksum_cache.mtime_cache.clear()
+            bb.parse.siggen.checksum_cache.stat_cache.clear()
 
     def matchFiles(self, bf, mc=''):
         """
@@ -2087,7 +2087,6 @@ class Parser(multiprocessing.Process):
         signal.signal(signal.SIGHUP, signal.SIG_DFL)
         signal.signal(signal.SIGINT, self.catch_sig)
         bb.utils.set_process_name(multiprocessing.current_process().name)
-        multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, exitpriority=1)
         multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
 
         pending = []
@@ -2268,7 +2267,7 @@ class CookerParser(object):
         sync = threading.Thread(target=sync_caches, name="SyncThread")
         self.syncthread = sync
         sync.start()
-        bb.codeparser.parser_cache_savemerge()
+        bb.codeparser.parser_cache_compact()
         bb.fetch.fetcher_parse_done()
         if self.cooker.configuration.profile:
             profiles = []
@@ -24,7 +24,7 @@ the speed is more critical here.
 #
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
-import sys, os, re
+import sys, os, re, io
 import hashlib
 if sys.argv[0][-5:] == "pydoc":
     path = os.path.dirname(os.path.dirname(sys.argv[1]))
@@ -210,28 +210,51 @@ def exported_vars(d):
         if value is not None:
             yield key, str(value)
 
+def _emit_cached(d, key, emit):
+    """
+    Return the shell code written by emit(o), reusing the output of an
+    earlier call for as long as the data store is not modified
+    """
+    generation = d.getGeneration()
+    cache = getattr(d, "_emit_cache", None)
+    if cache is None or cache[0] != generation:
+        cache = (generation, {})
+        d._emit_cache = cache
+    if key not in cache[1]:
+        o = io.StringIO()
+        emit(o)
+        cache[1][key] = o.getvalue()
+    return cache[1][key]
+
 def emit_func(func, o=sys.__stdout__, d = init()):
     """Emits all items in the data store in a format such that it can be sourced by a shell."""
 
-    keys = (key for key in d.keys() if not key.startswith("__") and not d.getVarFlag(key, "func", False))
-    for key in sorted(keys):
-        emit_var(key, o, d, False)
+    def emit_exports(o):
+        keys = (key for key in d.keys() if not key.startswith("__") and not d.getVarFlag(key, "func", False))
+        for key in sorted(keys):
+            emit_var(key, o, d, False)
+
+    def emit_funcs(o):
+        emit_var(func, o, d, False) and o.write('\n')
+        newdeps = bb.codeparser.ShellParser(func, logger).parse_shell(d.getVar(func))
+        newdeps |= set((d.getVarFlag(func, "vardeps") or "").split())
+        seen = set()
+        while newdeps:
+            deps = newdeps
+            seen |= deps
+            newdeps = set()
+            for dep in sorted(deps):
+                if d.getVarFlag(dep, "func", False) and not d.getVarFlag(dep, "python", False):
+                   emit_var(dep, o, d, False) and o.write('\n')
+                   newdeps |=  bb.codeparser.ShellParser(dep, logger).parse_shell(d.getVar(dep))
+                   newdeps |= set((d.getVarFlag(dep, "vardeps") or "").split())
+            newdeps -= seen
 
+    # Tasks running several shell functions in a row would otherwise expand
+    # the whole exported environment again for each of them
+    o.write(_emit_cached(d, None, emit_exports))
     o.write('\n')
-    emit_var(func, o, d, False) and o.write('\n')
-    newdeps = bb.codeparser.ShellParser(func, logger).parse_shell(d.getVar(func))
-    newdeps |= set((d.getVarFlag(func, "vardeps") or "").split())
-    seen = set()
-    while newdeps:
-        deps = newdeps
-        seen |= deps
-        newdeps = set()
-        for dep in sorted(deps):
-            if d.getVarFlag(dep, "func", False) and not d.getVarFlag(dep, "python", False):
-               emit_var(dep, o, d, False) and o.write('\n')
-               newdeps |=  bb.codeparser.ShellParser(dep, logger).parse_shell(d.getVar(dep))
-               newdeps |= set((d.getVarFlag(dep, "vardeps") or "").split())
-        newdeps -= seen
+    o.write(_emit_cached(d, func, emit_funcs))
 
 _functionfmt = """
 def {function}(d):
@@ -424,6 +424,11 @@ class DataSmart(MutableMapping):
 
         self.expand_cache = {}
 
+        # Modification counters of this data store and the ones it was
+        # copied from, see getGeneration()
+        self._generation = [0]
+        self._parentgenerations = []
+
         # cookie monster tribute
         # Need to be careful about writes to overridedata as
         # its only a shallow copy, could influence other data store
@@ -507,6 +512,7 @@ class DataSmart(MutableMapping):
 
     def initVar(self, var):
         self.expand_cache = {}
+        self._generation[0] += 1
         if not var in self.dict:
             self.dict[var] = {}
 
@@ -553,6 +559,7 @@ class DataSmart(MutableMapping):
             self.setVar("_FAILPARSINGERRORHANDLED", True)
 
         self.expand_cache = {}
+        self._generation[0] += 1
         parsing=False
         if 'parsing' in loginfo:
             parsing=True
@@ -710,6 +717,7 @@ class DataSmart(MutableMapping):
 
     def delVar(self, var, **loginfo):
         self.expand_cache = {}
+        self._generation[0] += 1
 
         loginfo['detail'] = ""
         loginfo['op'] = 'del'
@@ -737,6 +745,7 @@ class DataSmart(MutableMapping):
 
     def setVarFlag(self, var, flag, value, **loginfo):
         self.expand_cache = {}
+        self._generation[0] += 1
 
         if var == "BB_RENAMED_VARIABLES":
             self._var_renames[flag] = value
@@ -895,6 +904,7 @@ class DataSmart(MutableMapping):
 
     def delVarFlag(self, var, flag, **loginfo):
         self.expand_cache = {}
+        self._generation[0] += 1
 
         local_var, _ = self._findVar(var)
         if not local_var:
@@ -926,6 +936,7 @@ class DataSmart(MutableMapping):
 
     def setVarFlags(self, var, flags, **loginfo):
         self.expand_cache = {}
+        self._generation[0] += 1
         infer_caller_details(loginfo)
         if not var in self.dict:
             self._makeShadowCopy(var)
@@ -956,6 +967,7 @@ class DataSmart(MutableMapping):
 
     def delVarFlags(self, var, **loginfo):
         self.expand_cache = {}
+        self._generation[0] += 1
         if not var in self.dict:
             self._makeShadowCopy(var)
 
@@ -987,6 +999,8 @@ class DataSmart(MutableMapping):
         data._tracking = self._tracking
         data._var_renames = self._var_renames
 
+        data._parentgenerations = [self._generation] + self._parentgenerations
+
         data.overrides = None
         data.overridevars = copy.copy(self.overridevars)
         # Should really be a deepcopy but has heavy overhead.
@@ -995,6 +1009,13 @@ class DataSmart(MutableMapping):
 
         return data
 
+    def getGeneration(self):
+        """
+        Return a value which changes whenever this data store or one it
+        was copied from is modified, for caching data derived from it
+        """
+        return tuple(g[0] for g in [self._generation] + self._parentgenerations)
+
     def expandVarref(self, variable, parents=False):
         """Find all references to variable in the data and expand it
            in place, optionally descending to parent datastores."""
@@ -23,7 +23,9 @@ import collections
 import subprocess
 import pickle
 import errno
+import threading
 import bb.persist_data, bb.utils
+import bb.data
 import bb.checksum
 import bb.process
 import bb.event
@@ -1711,6 +1713,11 @@ class Fetch(object):
     def download(self, urls=None):
         """
         Fetch all urls
+
+        Independent urls are downloaded concurrently, with at most
+        BB_FETCH_THREADS downloads in total and BB_FETCH_THREADS_PER_HOST
+        downloads from the same host at a time. Urls sharing a lockfile are
+        downloaded one after another by the same thread.
         """
         if not urls:
             urls = self.urls
@@ -1718,96 +1725,164 @@ class Fetch(object):
         network = self.d.getVar("BB_NO_NETWORK")
         premirroronly = bb.utils.to_boolean(self.d.getVar("BB_FETCH_PREMIRRORONLY"))
 
+        groups = collections.OrderedDict()
         for u in urls:
             ud = self.ud[u]
             ud.setup_localpath(self.d)
-            m = ud.method
-            done = False
+            groups.setdefault(ud.lockfile or ud.localpath or u, []).append(u)
 
-            if ud.lockfile:
-                lf = bb.utils.lockfile(ud.lockfile)
+        threads = int(self.d.getVar("BB_FETCH_THREADS") or 4)
+        if threads <= 1 or len(groups) <= 1:
+            for u in urls:
+                self.download_url(u, self.d, network, premirroronly)
+            return
 
-            try:
-                self.d.setVar("BB_NO_NETWORK", network)
+        perhost = int(self.d.getVar("BB_FETCH_THREADS_PER_HOST") or 2)
+        self.download_parallel(list(groups.values()), network, premirroronly,
+                               threads, max(perhost, 1))
 
-                if m.verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
-                    done = True
-                elif m.try_premirror(ud, self.d):
-                    logger.debug("Trying PREMIRRORS")
-                    mirrors = mirror_from_string(self.d.getVar('PREMIRRORS'))
-                    done = m.try_mirrors(self, ud, self.d, mirrors)
-                    if done:
-                        try:
-                            # early checksum verification so that if the checksum of the premirror
-                            # contents mismatch the fetcher can still try upstream and mirrors
-                            m.update_donestamp(ud, self.d)
-                        except ChecksumError as e:
-                            logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
-                            logger.debug(str(e))
-                            done = False
-
-                if premirroronly:
-                    self.d.setVar("BB_NO_NETWORK", "1")
-
-                firsterr = None
-                verified_stamp = False
+    def download_parallel(self, groups, network, premirroronly, threads, perhost):
+        """
+        Download groups of urls concurrently. Once a download failed, no
+        further downloads are started and the error of the first failing
+        url (in SRC_URI order) is raised after the running ones finished.
+        """
+        import concurrent.futures
+
+        urls = [u for group in groups for u in group]
+        progress = FetchProgress(self.d, urls)
+        pending = list(groups)
+        running = {}
+        hosts = collections.Counter()
+        errors = []
+
+        def download_group(group):
+            for u in group:
+                ld = bb.data.createCopy(self.d)
+                ld.setVar("__BB_FETCH_PROGRESS", progress.handler(u))
+                self.download_url(u, ld, network, premirroronly)
+                progress.update(u, 100)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            while pending or running:
+                for group in list(pending):
+                    if errors or len(running) >= threads:
+                        break
+                    host = self.ud[group[0]].host
+                    if hosts[host] >= perhost:
+                        continue
+                    pending.remove(group)
+                    hosts[host] += 1
+                    running[executor.submit(download_group, group)] = (host, group)
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    host, group = running.pop(future)
+                    hosts[host] -= 1
+                    try:
+                        future.result()
+                    except BaseException as e:
+                        errors.append((urls.index(group[0]), e))
+
+        if errors:
+            raise min(errors, key=lambda error: error[0])[1]
+
+    def download_url(self, u, d, network, premirroronly):
+        """
+        Fetch a single url, using the datastore d
+        """
+        ud = self.ud[u]
+        m = ud.method
+        done = False
+
+        if ud.lockfile:
+            lf = bb.utils.lockfile(ud.lockfile)
+
+        try:
+            d.setVar("BB_NO_NETWORK", network)
+
+            if m.verify_donestamp(ud, d) and not m.need_update(ud, d):
+                done = True
+            elif m.try_premirror(ud, d):
+                logger.debug("Trying PREMIRRORS")
+                mirrors = mirror_from_string(d.getVar('PREMIRRORS'))
+                done = m.try_mirrors(self, ud, d, mirrors)
                 if done:
-                    verified_stamp = m.verify_donestamp(ud, self.d)
-                if not done and (not verified_stamp or m.need_update(ud, self.d)):
                     try:
-                        if not trusted_network(self.d, ud.url):
-                            raise UntrustedUrl(ud.url)
-                        logger.debug("Trying Upstream")
-                        m.download(ud, self.d)
-                        if hasattr(m, "build_mirror_data"):
-                            m.build_mirror_data(ud, self.d)
-                        done = True
-                        # early checksum verify, so that if checksum mismatched,
-                        # fetcher still have chance to fetch from mirror
-                        m.update_donestamp(ud, self.d)
-
-                    except bb.fetch2.NetworkAccess:
+                        # early checksum verification so that if the checksum of the premirror
+                        # contents mismatch the fetcher can still try upstream and mirrors
+                        m.update_donestamp(ud, d)
+                    except ChecksumError as e:
+                        logger.warning("Checksum failure encountered with premirror download of %s - will attempt other sources." % u)
+                        logger.debug(str(e))
+                        done = False
+
+            if premirroronly:
+                d.setVar("BB_NO_NETWORK", "1")
+
+            firsterr = None
+            verified_stamp = False
+            if done:
+                verified_stamp = m.verify_donestamp(ud, d)
+            if not done and (not verified_stamp or m.need_update(ud, d)):
+                try:
+                    if not trusted_network(d, ud.url):
+                        raise UntrustedUrl(ud.url)
+                    logger.debug("Trying Upstream")
+                    m.download(ud, d)
+                    if hasattr(m, "build_mirror_data"):
+                        m.build_mirror_data(ud, d)
+                    done = True
+                    # early checksum verify, so that if checksum mismatched,
+                    # fetcher still have chance to fetch from mirror
+                    m.update_donestamp(ud, d)
+
+                except bb.fetch2.NetworkAccess:
+                    raise
+
+                except BBFetchException as e:
+                    if isinstance(e, ChecksumError):
+                        logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
+                        logger.debug(str(e))
+                        if os.path.exists(ud.localpath):
+                            rename_bad_checksum(ud, e.checksum)
+                    elif isinstance(e, NoChecksumError):
                         raise
+                    else:
+                        logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
+                        logger.debug(str(e))
+                    firsterr = e
+                    # Remove any incomplete fetch
+                    if not verified_stamp:
+                        m.clean(ud, d)
+                    logger.debug("Trying MIRRORS")
+                    mirrors = mirror_from_string(d.getVar('MIRRORS'))
+                    done = m.try_mirrors(self, ud, d, mirrors)
+
+            if not done or not m.done(ud, d):
+                if firsterr:
+                    logger.error(str(firsterr))
+                raise FetchError("Unable to fetch URL from any source.", u)
+
+            m.update_donestamp(ud, d)
+
+        except IOError as e:
+            if e.errno in [errno.ESTALE]:
+                logger.error("Stale Error Observed %s." % u)
+                raise ChecksumError("Stale Error Detected")
+
+        except BBFetchException as e:
+            if isinstance(e, ChecksumError):
+                logger.error("Checksum failure fetching %s" % u)
+            raise
 
-                    except BBFetchException as e:
-                        if isinstance(e, ChecksumError):
-                            logger.warning("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
-                            logger.debug(str(e))
-                            if os.path.exists(ud.localpath):
-                                rename_bad_checksum(ud, e.checksum)
-                        elif isinstance(e, NoChecksumError):
-                            raise
-                        else:
-                            logger.warning('Failed to fetch URL %s, attempting MIRRORS if available' % u)
-                            logger.debug(str(e))
-                        firsterr = e
-                        # Remove any incomplete fetch
-                        if not verified_stamp:
-                            m.clean(ud, self.d)
-                        logger.debug("Trying MIRRORS")
-                        mirrors = mirror_from_string(self.d.getVar('MIRRORS'))
-                        done = m.try_mirrors(self, ud, self.d, mirrors)
-
-                if not done or not m.done(ud, self.d):
-                    if firsterr:
-                        logger.error(str(firsterr))
-                    raise FetchError("Unable to fetch URL from any source.", u)
-
-                m.update_donestamp(ud, self.d)
-
-            except IOError as e:
-                if e.errno in [errno.ESTALE]:
-                    logger.error("Stale Error Observed %s." % u)
-                    raise ChecksumError("Stale Error Detected")
-
-            except BBFetchException as e:
-                if isinstance(e, ChecksumError):
-                    logger.error("Checksum failure fetching %s" % u)
-                raise
-
-            finally:
-                if ud.lockfile:
-                    bb.utils.unlockfile(lf)
+        finally:
+            if ud.lockfile:
+                bb.utils.unlockfile(lf)
 
     def checkstatus(self, urls=None):
         """
@@ -1905,6 +1980,30 @@ class Fetch(object):
 
         return urldata
 
+class FetchProgress(object):
+    """
+    Merge the progress of concurrent downloads into one task progress, each
+    url accounting for an equal share of it.
+    """
+    def __init__(self, d, urls):
+        self.d = d
+        self.progress = dict.fromkeys(urls, 0)
+        self.total = -1
+        self.lock = threading.Lock()
+
+    def handler(self, url):
+        return lambda progress, rate=None: self.update(url, progress, rate)
+
+    def update(self, url, progress, rate=None):
+        # Negative values only signal activity without a known progress
+        with self.lock:
+            self.progress[url] = min(max(progress, 0), 100)
+            total = sum(self.progress.values()) // len(self.progress)
+            if total == self.total:
+                return
+            self.total = total
+            bb.event.fire(bb.build.TaskProgress(total, rate), self.d)
+
 class FetchConnectionCache(object):
     """
         A class which represents an container for socket connections.
@@ -52,6 +52,12 @@ Supported SRC_URI options are:
    For local git:// urls to use the current branch HEAD as the revision for use with
    AUTOREV. Implies nobranch.
 
+- pool
+   The name of the object pool the repository shares its objects with when
+   BB_GIT_OBJECT_POOL is enabled. By default, repositories are grouped by
+   their root commit, set pool=<family> to group e.g. forks which do not
+   share one.
+
 """
 
 # Copyright (C) 2005 Richard Purdie
@@ -65,6 +71,7 @@ import fnmatch
 import os
 import re
 import shlex
+import shutil
 import subprocess
 import tempfile
 import bb
@@ -273,6 +280,10 @@ class Git(FetchMethod):
         ud.clonedir = os.path.join(gitdir, gitsrcname)
         ud.localfile = ud.clonedir
 
+        ud.objectpool = bb.utils.to_boolean(d.getVar("BB_GIT_OBJECT_POOL"))
+        ud.poolfamily = ud.parm.get("pool")
+        ud.pooldir = d.getVar("BB_GIT_OBJECT_POOL_DIR") or os.path.join(gitdir, ".pool")
+
         mirrortarball = 'git2_%s.tar.gz' % gitsrcname
         ud.fullmirror = os.path.join(dl_dir, mirrortarball)
         ud.mirrortarballs = [mirrortarball]
@@ -367,6 +378,10 @@ class Git(FetchMethod):
                 if os.path.isdir(objects) and not os.path.islink(objects):
                     repourl = repourl_path
             clone_cmd = "LANG=C %s clone --bare --mirror %s %s --progress" % (ud.basecmd, shlex.quote(repourl), ud.clonedir)
+            if ud.objectpool:
+                # Only transfer the objects which no related repository has
+                for pool in self._pool_candidates(ud, d):
+                    clone_cmd += " --reference-if-able %s" % shlex.quote(pool)
             if ud.proto.lower() != 'file':
                 bb.fetch2.check_network_access(d, clone_cmd, ud.url)
             progresshandler = GitProgressHandler(d)
@@ -406,6 +421,9 @@ class Git(FetchMethod):
             if missing_rev:
                 raise bb.fetch2.FetchError("Unable to find revision %s even from upstream" % missing_rev)
 
+        if ud.objectpool:
+            self._add_to_pool(ud, d)
+
         if self._contains_lfs(ud, d, ud.clonedir) and self._need_lfs(ud):
             # Unpack temporary working copy, use it to run 'git checkout' to force pre-fetching
             # of all LFS blobs needed at the srcrev.
@@ -470,13 +488,76 @@ class Git(FetchMethod):
                 os.unlink(ud.fullmirror)
 
             logger.info("Creating tarball of git repository")
-            with create_atomic(ud.fullmirror) as tfile:
-                mtime = runfetchcmd("git log --all -1 --format=%cD", d,
-                        quiet=True, workdir=ud.clonedir)
-                runfetchcmd("tar -czf %s --owner oe:0 --group oe:0 --mtime \"%s\" ."
-                        % (tfile, mtime), d, workdir=ud.clonedir)
+            tempdir = None
+            tarsrc = ud.clonedir
+            if os.path.exists(os.path.join(ud.clonedir, "objects", "info", "alternates")):
+                # The tarball has to contain the objects borrowed from the pool
+                tempdir = tempfile.mkdtemp(dir=d.getVar('DL_DIR'))
+                tarsrc = os.path.join(tempdir, 'git')
+                runfetchcmd("%s clone --bare --mirror --no-local file://%s %s"
+                        % (ud.basecmd, ud.clonedir, tarsrc), d)
+                shutil.copy(os.path.join(ud.clonedir, "config"), tarsrc)
+            try:
+                with create_atomic(ud.fullmirror) as tfile:
+                    mtime = runfetchcmd("git log --all -1 --format=%cD", d,
+                            quiet=True, workdir=ud.clonedir)
+                    runfetchcmd("tar -czf %s --owner oe:0 --group oe:0 --mtime \"%s\" ."
+                            % (tfile, mtime), d, workdir=tarsrc)
+            finally:
+                if tempdir:
+                    bb.utils.remove(tempdir, recurse=True)
             runfetchcmd("touch %s.done" % ud.fullmirror, d)
 
+    def _pool_candidates(self, ud, d):
+        """
+        Return the object pools a new clone may borrow objects from. The
+        root commit of a repository is only known after cloning it, so all
+        pools are candidates unless a pool family is set.
+        """
+        if ud.poolfamily:
+            names = [self._pool_name(ud, d)]
+        elif os.path.isdir(ud.pooldir):
+            names = sorted(os.listdir(ud.pooldir))
+        else:
+            names = []
+        pools = [os.path.join(ud.pooldir, name) for name in names]
+        return [pool for pool in pools if os.path.isdir(os.path.join(pool, "objects"))]
+
+    def _pool_name(self, ud, d):
+        if ud.poolfamily:
+            return "family-%s" % ud.poolfamily.replace('/', '.')
+        revision = ud.revisions[ud.names[0]]
+        output = runfetchcmd("%s rev-list --max-parents=0 --first-parent %s"
+                             % (ud.basecmd, revision), d, quiet=True, workdir=ud.clonedir)
+        return "root-%s" % output.split()[-1]
+
+    def _add_to_pool(self, ud, d):
+        """
+        Move the objects of the clone into the object pool of its family and
+        let the clone borrow them from there. The pool keeps the refs of all
+        its repositories, so none of the objects become unreachable.
+        """
+        pool = os.path.join(ud.pooldir, self._pool_name(ud, d))
+        refs = "+refs/*:refs/remotes/%s/*" % os.path.basename(ud.clonedir)
+
+        lf = bb.utils.lockfile(pool + ".lock")
+        try:
+            if not os.path.exists(os.path.join(pool, "objects")):
+                bb.utils.mkdirhier(pool)
+                runfetchcmd("%s init --bare --quiet" % ud.basecmd, d, workdir=pool)
+                runfetchcmd("%s config gc.pruneExpire never" % ud.basecmd, d, workdir=pool)
+            runfetchcmd("%s fetch --quiet --no-tags %s %s"
+                        % (ud.basecmd, shlex.quote(ud.clonedir), refs), d, workdir=pool)
+        finally:
+            bb.utils.unlockfile(lf)
+
+        # Use a relative path, so that DL_DIR can be moved or bind-mounted
+        objects = os.path.realpath(os.path.join(ud.clonedir, "objects"))
+        bb.utils.mkdirhier(os.path.join(objects, "info"))
+        with open(os.path.join(objects, "info", "alternates"), "w") as f:
+            f.write(os.path.relpath(os.path.join(os.path.realpath(pool), "objects"), objects) + "\n")
+        runfetchcmd("%s repack -a -d -l -q" % ud.basecmd, d, workdir=ud.clonedir)
+
     def clone_shallow_local(self, ud, dest, d):
         """Clone the repo and make it shallow.
 
@@ -58,6 +58,11 @@ class ProgressHandler:
 
     def _fire_progress(self, taskprogress, rate=None):
         """Internal function to fire the progress event"""
+        # Concurrent downloads report to the fetcher, which merges them
+        fetchprogress = self._data.getVar("__BB_FETCH_PROGRESS", False)
+        if fetchprogress:
+            fetchprogress(taskprogress, rate)
+            return
         bb.event.fire(bb.build.TaskProgress(taskprogress, rate), self._data)
 
     def write(self, string):
@@ -9,6 +9,8 @@
 
 import unittest
 import logging
+import os
+import tempfile
 import bb
 
 logger = logging.getLogger('BitBake.TestCodeParser')
@@ -438,3 +440,99 @@ esac
     #    self.assertEquals(deps, set(["oe_libinstall"]))
 
 
+class CodeParserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory(prefix="bitbake-codeparser-")
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", self.tempdir.name)
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.tempdir.cleanup()
+
+    def newCache(self):
+        cache = bb.codeparser.CodeParserCache()
+        cache.init_cache(self.d)
+        self.caches.append(cache)
+        return cache
+
+    def test_shared_between_instances(self):
+        writer = self.newCache()
+        reader = self.newCache()
+        line = writer.newShellCacheLine(set(["echo"]))
+        writer.append(writer.SHELL, "abc", line)
+        self.assertEqual(reader.get(reader.SHELL, "abc").execs, frozenset(["echo"]))
+        self.assertIsNone(reader.get(reader.PYTHON, "abc"))
+
+        # A fresh instance loads everything from the log
+        self.assertEqual(self.newCache().get(writer.SHELL, "abc").execs, frozenset(["echo"]))
+
+    def test_compact(self):
+        first = self.newCache()
+        second = self.newCache()
+        for cache in (first, second):
+            cache.append(cache.SHELL, "abc", cache.newShellCacheLine(set(["echo"])))
+            cache.append(cache.SHELL, "def", cache.newShellCacheLine(set(["cat"])))
+        first.append(first.PYTHON, "ghi", first.newPythonCacheLine(set(["FOO"]), set(), {}))
+
+        first.compact()
+        self.assertEqual(first.records, 5)
+        first.compact(force=True)
+        self.assertEqual(first.records, 3)
+
+        # The other instance notices the rewrite and reloads
+        self.assertEqual(second.get(second.PYTHON, "ghi").refs, frozenset(["FOO"]))
+        self.assertEqual(second.records, 3)
+
+    def test_damaged_log(self):
+        cache = self.newCache()
+        cache.append(cache.SHELL, "abc", cache.newShellCacheLine(set(["echo"])))
+        with open(cache.cachefile, "ab") as f:
+            f.write(cache.record.pack(4, 0) + b"junk")
+        cache.append(cache.SHELL, "def", cache.newShellCacheLine(set(["cat"])))
+
+        reader = self.newCache()
+        self.assertTrue(reader.corrupt)
+        self.assertIsNotNone(reader.get(reader.SHELL, "abc"))
+        self.assertIsNone(reader.get(reader.SHELL, "def"))
+
+        cache.compact()
+        reader.sync()
+        self.assertFalse(reader.corrupt)
+        self.assertIsNotNone(reader.get(reader.SHELL, "def"))
+
+    def test_truncated_record(self):
+        cache = self.newCache()
+        cache.append(cache.SHELL, "abc", cache.newShellCacheLine(set(["echo"])))
+        with open(cache.cachefile, "ab") as f:
+            f.write(cache.record.pack(0xffffffff, 0) + b"junk")
+
+        # Without the lock the record might still be written
+        reader = self.newCache()
+        self.assertFalse(reader.corrupt)
+        reader.compact()
+        self.assertFalse(reader.corrupt)
+        self.assertEqual(reader.records, 1)
+
+        reader.append(reader.SHELL, "def", reader.newShellCacheLine(set(["cat"])))
+        self.assertIsNotNone(cache.get(cache.SHELL, "def"))
+        self.assertIsNotNone(self.newCache().get(cache.SHELL, "def"))
+
+    def test_append_after_compact(self):
+        first = self.newCache()
+        second = self.newCache()
+        first.append(first.SHELL, "abc", first.newShellCacheLine(set(["echo"])))
+        first.compact(force=True)
+        second.append(second.SHELL, "def", second.newShellCacheLine(set(["cat"])))
+        self.assertIsNotNone(first.get(first.SHELL, "def"))
+        self.assertIsNotNone(self.newCache().get(first.SHELL, "abc"))
+
+    def test_version_mismatch(self):
+        cache = self.newCache()
+        cache.append(cache.SHELL, "abc", cache.newShellCacheLine(set(["echo"])))
+        cache.close()
+        with open(cache.cachefile, "r+b") as f:
+            f.write(cache.header.pack(cache.magic, cache.CACHE_VERSION - 1))
+        self.assertIsNone(self.newCache().get(cache.SHELL, "abc"))
@@ -13,6 +13,7 @@ import bb.data
 import bb.parse
 import logging
 import os
+import io
 
 class LogRecord():
     def __enter__(self):
@@ -527,6 +528,52 @@ class TaskHash(unittest.TestCase):
         nexthash = gettask_bashhash("mytask", d)
         self.assertEqual(orighash, nexthash)
 
+class EmitFunc(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVarFlag("FOO", "export", "1")
+        self.d.setVar("BAR", "${FOO}bar")
+        self.d.setVarFlag("BAR", "export", "1")
+        self.d.setVar("myfunc", "helper; echo $BAR")
+        self.d.setVarFlag("myfunc", "func", "1")
+        self.d.setVar("helper", "true")
+        self.d.setVarFlag("helper", "func", "1")
+
+    def emit(self, func, d):
+        o = io.StringIO()
+        bb.data.emit_func(func, o, d)
+        return o.getvalue()
+
+    def test_emit(self):
+        out = self.emit("myfunc", self.d)
+        self.assertIn('export BAR="foobar"\n', out)
+        self.assertIn('export FOO="foo"\n', out)
+        self.assertIn("myfunc() {\nhelper; echo $BAR\n}\n", out)
+        self.assertIn("helper() {\ntrue\n}\n", out)
+        self.assertEqual(self.emit("myfunc", self.d), out)
+
+    def test_emit_modified(self):
+        d = self.d.createCopy()
+        self.assertIn('export BAR="foobar"\n', self.emit("myfunc", d))
+        generation = d.getGeneration()
+
+        # Changes to the data store it was copied from count as well
+        self.d.setVar("OTHER", "value")
+        self.assertNotEqual(d.getGeneration(), generation)
+
+        d.setVar("FOO", "baz")
+        self.assertIn('export BAR="bazbar"\n', self.emit("myfunc", d))
+
+        d.setVar("helper", "false")
+        self.assertIn("false", self.emit("myfunc", d))
+
+        # Reading doesn't count as a modification
+        generation = d.getGeneration()
+        d.getVar("BAR")
+        d.expand("${FOO}")
+        self.assertEqual(d.getGeneration(), generation)
+
 class Serialize(unittest.TestCase):
 
     def test_serialize(self):
@@ -12,6 +12,7 @@ import tempfile
 import collections
 import os
 import tarfile
+import unittest.mock
 from bb.fetch2 import URI
 from bb.fetch2 import FetchMethod
 import bb
@@ -787,6 +788,61 @@ class FetcherLocalTest(FetcherTest):
         alt = os.path.join(self.unpackdir, 'git/.git/objects/info/alternates')
         self.assertFalse(os.path.exists(alt))
 
+class FileChecksumCacheTest(FetcherTest):
+    def setUp(self):
+        super(FileChecksumCacheTest, self).setUp()
+        self.srcdir = os.path.join(self.tempdir, 'files')
+        os.makedirs(os.path.join(self.srcdir, 'subdir'))
+        for name, content in (('a', 'foo'), ('b', 'bar'), ('subdir/c', 'baz')):
+            with open(os.path.join(self.srcdir, name), 'w') as f:
+                f.write(content)
+        os.link(os.path.join(self.srcdir, 'a'), os.path.join(self.srcdir, 'subdir', 'hardlink'))
+        self.cache = bb.checksum.FileChecksumCache()
+        self.cache.init_cache(self.d)
+
+    def md5(self, content):
+        return hashlib.md5(content.encode()).hexdigest()
+
+    def test_tree(self):
+        with unittest.mock.patch('bb.utils.md5_file', wraps=bb.utils.md5_file) as md5_file:
+            checksums = self.cache.get_checksums("%s:True" % self.srcdir, "test", [])
+        self.assertEqual(sorted(checksums), sorted([
+            (os.path.join(self.srcdir, '.', 'a'), self.md5('foo')),
+            (os.path.join(self.srcdir, '.', 'b'), self.md5('bar')),
+            (os.path.join(self.srcdir, '.', 'subdir/c'), self.md5('baz')),
+            (os.path.join(self.srcdir, '.', 'subdir/hardlink'), self.md5('foo')),
+        ]))
+        # The hardlink shares its inode with 'a' so it is only hashed once
+        self.assertEqual(md5_file.call_count, 3)
+        self.assertEqual(len(self.cache.cachedata_extras[0]), 4)
+
+    def test_missing_and_excluded(self):
+        filelist = "%s:True %s:True %s:False" % (self.srcdir,
+                                                 os.path.join(self.tempdir, 'missing'),
+                                                 os.path.join(self.tempdir, 'ignored'))
+        with unittest.mock.patch('bb.warn') as warn:
+            checksums = self.cache.get_checksums(filelist, "test", ["subdir"])
+        self.assertEqual(sorted(os.path.basename(f) for f, _ in checksums), ['a', 'b'])
+        warn.assert_called_once()
+
+    def test_changed_file(self):
+        fn = os.path.join(self.srcdir, 'b')
+        self.assertEqual(self.cache.get_checksum(fn), self.md5('bar'))
+        with open(fn, 'w') as f:
+            f.write('changed')
+        os.utime(fn, ns=(0, 0))
+        self.cache.stat_cache.clear()
+        self.assertEqual(self.cache.get_checksum(fn), self.md5('changed'))
+
+        # A new instance picks the digests up from the persistent cache
+        self.cache.save_extras()
+        self.cache.save_merge()
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        # The stale entry was replaced rather than kept next to the new one
+        self.assertEqual(len(cache.cachedata[0]), 1)
+        self.assertEqual(cache.get_checksum(fn), self.md5('changed'))
+
 class FetcherNoNetworkTest(FetcherTest):
     def setUp(self):
         super().setUp()
@@ -890,6 +946,49 @@ class FetcherNoNetworkTest(FetcherTest):
         self.assertFalse(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz")))
         self.assertFalse(os.path.exists(os.path.join(self.dldir, "test-file.tar.gz.done")))
 
+class FetchParallelTest(FetcherTest):
+    def setUp(self):
+        super().setUp()
+        self.d.setVar("BB_NO_NETWORK", "1")
+        self.mirrordir = os.path.join(self.tempdir, "mirror")
+        os.mkdir(self.mirrordir)
+        self.d.setVar("PREMIRRORS", "http://.*/.* file://%s/" % self.mirrordir)
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        self.d.setVar("BB_FETCH_THREADS_PER_HOST", "2")
+        self.urls = []
+        for i in range(8):
+            name = "file%d.tar.gz" % i
+            with open(os.path.join(self.mirrordir, name), "w") as f:
+                f.write("content %d\n" % i)
+            self.urls.append("http://host%d.example.com/%s" % (i % 2, name))
+
+    def test_parallel_download(self):
+        fetcher = bb.fetch.Fetch(self.urls, self.d)
+        fetcher.download()
+        for i in range(8):
+            with open(os.path.join(self.dldir, "file%d.tar.gz" % i)) as f:
+                self.assertEqual(f.read(), "content %d\n" % i)
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, "file%d.tar.gz.done" % i)))
+        self.assertEqual(self.d.getVar("BB_NO_NETWORK"), "1")
+
+    def test_parallel_download_error(self):
+        os.unlink(os.path.join(self.mirrordir, "file3.tar.gz"))
+        os.unlink(os.path.join(self.mirrordir, "file6.tar.gz"))
+        fetcher = bb.fetch.Fetch(self.urls, self.d)
+        with self.assertRaises(bb.fetch2.NetworkAccess) as cm:
+            fetcher.download()
+        self.assertIn("file3.tar.gz", str(cm.exception))
+
+    def test_merged_progress(self):
+        events = []
+        progress = bb.fetch2.FetchProgress(self.d, ["a", "b"])
+        with unittest.mock.patch("bb.event.fire", lambda e, d: events.append(e.progress)):
+            progress.handler("a")(-1)
+            progress.handler("a")(50)
+            progress.handler("b")(100)
+            progress.update("a", 100)
+        self.assertEqual(events, [0, 25, 75, 100])
+
 class FetcherNetworkTest(FetcherTest):
     @skipIfNoNetwork()
     def test_fetch(self):
@@ -2158,6 +2257,90 @@ class GitShallowTest(FetcherTest):
         dir = os.listdir(self.unpackdir + "/git/")
         self.assertIn("fstests.doap", dir)
 
+class GitObjectPoolTest(FetcherTest):
+    def setUp(self):
+        super().setUp()
+        self.d.setVar('WORKDIR', self.tempdir)
+        self.d.setVar('BB_GIT_OBJECT_POOL', '1')
+        self.d.setVar('BB_GENERATE_MIRROR_TARBALLS', '0')
+        self.d.setVar("__BBSEENSRCREV", "1")
+        self.d.delVar('PREMIRRORS')
+        self.d.delVar('MIRRORS')
+
+        self.upstream = os.path.join(self.tempdir, 'upstream')
+        bb.utils.mkdirhier(self.upstream)
+        self.git_init(cwd=self.upstream)
+        self.commit(self.upstream, 'a')
+        self.commit(self.upstream, 'b')
+
+        self.fork = os.path.join(self.tempdir, 'fork')
+        self.git(['clone', self.upstream, self.fork], cwd=self.tempdir)
+        self.git_init(cwd=self.fork)
+        self.commit(self.fork, 'c')
+
+    def commit(self, cwd, name):
+        with open(os.path.join(cwd, name), 'w') as f:
+            f.write(name)
+        self.git(['add', name], cwd=cwd)
+        self.git(['commit', '-m', name], cwd=cwd)
+        return self.git(['rev-parse', 'HEAD'], cwd=cwd).strip()
+
+    def fetch(self, repo, params=''):
+        d = self.d.createCopy()
+        d.setVar('SRCREV', self.git(['rev-parse', 'HEAD'], cwd=repo).strip())
+        url = 'git://%s;protocol=file;branch=master%s' % (repo, params)
+        fetcher = bb.fetch.Fetch([url], d)
+        fetcher.download()
+        return fetcher, fetcher.ud[url]
+
+    def alternates(self, ud):
+        with open(os.path.join(ud.clonedir, 'objects', 'info', 'alternates')) as f:
+            return os.path.normpath(os.path.join(ud.clonedir, 'objects', f.read().strip()))
+
+    def test_pool_by_root_commit(self):
+        _, ud_upstream = self.fetch(self.upstream)
+        fetcher, ud_fork = self.fetch(self.fork)
+
+        root = self.git(['rev-list', '--max-parents=0', 'HEAD'], cwd=self.upstream).strip()
+        pool = os.path.join(self.dldir, 'git2', '.pool', 'root-%s' % root)
+        self.assertEqual(self.alternates(ud_upstream), os.path.join(pool, 'objects'))
+        self.assertEqual(self.alternates(ud_fork), os.path.join(pool, 'objects'))
+
+        # The objects live in the pool only
+        counts = self.git(['count-objects', '-v'], cwd=ud_fork.clonedir).splitlines()
+        self.assertIn('count: 0', counts)
+        self.assertIn('in-pack: 0', counts)
+        self.git(['fsck', '--connectivity-only'], cwd=ud_fork.clonedir)
+
+        fetcher.unpack(self.unpackdir)
+        self.assertTrue(os.path.exists(os.path.join(self.unpackdir, 'git', 'c')))
+
+    def test_pool_family(self):
+        other = os.path.join(self.tempdir, 'other')
+        bb.utils.mkdirhier(other)
+        self.git_init(cwd=other)
+        self.commit(other, 'd')
+
+        _, ud_upstream = self.fetch(self.upstream, ';pool=family')
+        _, ud_other = self.fetch(other, ';pool=family')
+
+        pool = os.path.join(self.dldir, 'git2', '.pool', 'family-family', 'objects')
+        self.assertEqual(self.alternates(ud_upstream), pool)
+        self.assertEqual(self.alternates(ud_other), pool)
+
+    def test_pool_mirror_tarball(self):
+        self.d.setVar('BB_GENERATE_MIRROR_TARBALLS', '1')
+        _, ud = self.fetch(self.upstream)
+        self.assertTrue(os.path.exists(ud.fullmirror))
+
+        # The tarball is usable without the pool
+        extracted = os.path.join(self.tempdir, 'extracted')
+        bb.utils.mkdirhier(extracted)
+        with tarfile.open(ud.fullmirror) as tf:
+            tf.extractall(extracted)
+        self.assertFalse(os.path.exists(os.path.join(extracted, 'objects', 'info', 'alternates')))
+        self.git(['fsck', '--connectivity-only'], cwd=extracted)
+
 class GitLfsTest(FetcherTest):
     def setUp(self):
         FetcherTest.setUp(self)
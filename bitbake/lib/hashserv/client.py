@@ -16,6 +16,11 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
     MODE_NORMAL = 0
     MODE_GET_STREAM = 1
 
+    # Maximum number of stream requests sent before reading the replies.
+    # This keeps both sides well within the socket buffers so that neither
+    # can block writing while the other is also writing
+    STREAM_BATCH_SIZE = 256
+
     def __init__(self):
         super().__init__('OEHASHEQUIV', '1.1', logger)
         self.mode = self.MODE_NORMAL
@@ -37,6 +42,20 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
 
         return await self._send_wrapper(proc)
 
+    async def send_stream_batch(self, msgs):
+        async def proc():
+            self.writer.write("".join("%s\n" % m for m in msgs).encode("utf-8"))
+            await self.writer.drain()
+            results = []
+            for _ in msgs:
+                l = await self.reader.readline()
+                if not l:
+                    raise ConnectionError("Connection closed")
+                results.append(l.decode("utf-8").rstrip())
+            return results
+
+        return await self._send_wrapper(proc)
+
     async def _set_mode(self, new_mode):
         if new_mode == self.MODE_NORMAL and self.mode == self.MODE_GET_STREAM:
             r = await self.send_stream("END")
@@ -60,6 +79,21 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
             return None
         return r
 
+    async def get_unihash_batch(self, args):
+        """
+        Look up the unihash of each (method, taskhash) pair in args. The
+        requests are pipelined instead of waiting for each reply in turn.
+        """
+        await self._set_mode(self.MODE_GET_STREAM)
+        results = []
+        args = list(args)
+        for i in range(0, len(args), self.STREAM_BATCH_SIZE):
+            r = await self.send_stream_batch(
+                ["%s %s" % (method, taskhash) for method, taskhash in args[i:i + self.STREAM_BATCH_SIZE]]
+            )
+            results.extend(u or None for u in r)
+        return results
+
     async def report_unihash(self, taskhash, method, outhash, unihash, extra={}):
         await self._set_mode(self.MODE_NORMAL)
         m = extra.copy()
@@ -108,6 +142,7 @@ class Client(bb.asyncrpc.Client):
         self._add_methods(
             "connect_tcp",
             "get_unihash",
+            "get_unihash_batch",
             "report_unihash",
             "report_unihash_equiv",
             "get_taskhash",
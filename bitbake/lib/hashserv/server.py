@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+from collections import OrderedDict
 from contextlib import closing, contextmanager
 from datetime import datetime
 import enum
@@ -16,6 +17,16 @@ import bb.asyncrpc
 
 logger = logging.getLogger('hashserv.server')
 
+# How long reports wait for other writers before their changes are committed
+# to the database together
+DEFAULT_COMMIT_INTERVAL = 0.01
+
+# Number of taskhash -> unihash mappings kept in memory
+DEFAULT_UNIHASH_CACHE_SIZE = 100000
+
+# Maximum number of get-stream requests read from a client at once
+STREAM_READ_SIZE = 64 * 1024
+
 
 class Measurement(object):
     def __init__(self, sample):
@@ -114,6 +125,76 @@ class Resolve(enum.Enum):
     REPLACE = enum.auto()
 
 
+class UnihashCache(object):
+    """
+    LRU of (method, taskhash) -> unihash mappings. Rows in unihashes_v2 are
+    never changed once they have been inserted, so a mapping can be cached
+    for as long as it is wanted. Misses are never cached, since another
+    server sharing the database may add the row at any time.
+    """
+    def __init__(self, max_entries=DEFAULT_UNIHASH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, method, taskhash):
+        key = (method, taskhash)
+        unihash = self.entries.get(key)
+        if unihash is not None:
+            self.entries.move_to_end(key)
+        return unihash
+
+    def add(self, method, taskhash, unihash):
+        if self.max_entries <= 0:
+            return
+        self.entries[(method, taskhash)] = unihash
+        self.entries.move_to_end((method, taskhash))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class GroupCommit(object):
+    """
+    Batches database commits. Writers call schedule() (or await commit() if
+    they must not answer until the data is durable) and all changes made
+    within the commit interval are committed in one transaction.
+    """
+    def __init__(self, db, loop, interval=DEFAULT_COMMIT_INTERVAL):
+        self.db = db
+        self.loop = loop
+        self.interval = interval
+        self.pending = None
+
+    def schedule(self):
+        if self.pending is None:
+            self.pending = self.loop.create_future()
+            self.loop.call_later(self.interval, self._commit)
+        return self.pending
+
+    async def commit(self):
+        # Shield the shared future so that a client disconnecting while
+        # waiting doesn't cancel the commit for every other waiter
+        await asyncio.shield(self.schedule())
+
+    def flush(self):
+        if self.pending is not None:
+            self._commit()
+        else:
+            self.db.commit()
+
+    def _commit(self):
+        pending = self.pending
+        self.pending = None
+        if pending is None:
+            return
+
+        try:
+            self.db.commit()
+        except Exception as e:
+            pending.set_exception(e)
+        else:
+            pending.set_result(None)
+
+
 def insert_table(cursor, table, data, on_conflict):
     resolve = {
         Resolve.FAIL: "",
@@ -153,7 +234,6 @@ async def copy_unihash_from_upstream(client, db, method, taskhash):
                 {k: v for k, v in d.items() if k in UNIHASH_TABLE_COLUMNS},
                 Resolve.IGNORE,
             )
-            db.commit()
     return d
 
 
@@ -165,9 +245,12 @@ class ServerCursor(object):
 
 
 class ServerClient(bb.asyncrpc.AsyncServerConnection):
-    def __init__(self, reader, writer, db, request_stats, backfill_queue, upstream, read_only):
+    def __init__(self, reader, writer, db, request_stats, backfill_queue, upstream, read_only,
+                 unihash_cache, group_commit):
         super().__init__(reader, writer, 'OEHASHEQUIV', logger)
         self.db = db
+        self.unihash_cache = unihash_cache
+        self.group_commit = group_commit
         self.request_stats = request_stats
         self.max_chunk = bb.asyncrpc.DEFAULT_MAX_CHUNK
         self.backfill_queue = backfill_queue
@@ -251,7 +334,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             elif self.upstream_client is not None:
                 d = await self.upstream_client.get_taskhash(method, taskhash, True)
                 self.update_unified(cursor, d)
-                self.db.commit()
+                self.group_commit.schedule()
         else:
             row = self.query_equivalent(cursor, method, taskhash)
 
@@ -261,7 +344,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 d = await self.upstream_client.get_taskhash(method, taskhash)
                 d = {k: v for k, v in d.items() if k in UNIHASH_TABLE_COLUMNS}
                 insert_unihash(cursor, d, Resolve.IGNORE)
-                self.db.commit()
+                self.group_commit.schedule()
 
         return d
 
@@ -297,7 +380,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         elif self.upstream_client is not None:
             d = await self.upstream_client.get_outhash(method, outhash, taskhash)
             self.update_unified(cursor, d)
-            self.db.commit()
+            self.group_commit.schedule()
 
         return d
 
@@ -319,58 +402,73 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
     async def handle_get_stream(self, request):
         self.write_message('ok')
 
+        buf = b''
         while True:
-            upstream = None
-
-            l = await self.reader.readline()
-            if not l:
+            # Read everything the client has sent so far. Clients that
+            # pipeline their requests will have several lines queued up,
+            # which are then answered together
+            data = await self.reader.read(STREAM_READ_SIZE)
+            if not data:
                 return
 
-            try:
-                # This inner loop is very sensitive and must be as fast as
-                # possible (which is why the request sample is handled manually
-                # instead of using 'with', and also why logging statements are
-                # commented out.
-                self.request_sample = self.request_stats.start_sample()
-                request_measure = self.request_sample.measure()
-                request_measure.start()
-
+            lines = (buf + data).split(b'\n')
+            buf = lines.pop()
+            if not lines:
+                continue
+
+            # This inner loop is very sensitive and must be as fast as
+            # possible (which is why the request sample is handled manually
+            # instead of using 'with', and also why logging statements are
+            # commented out.
+            self.request_sample = self.request_stats.start_sample()
+            request_measure = self.request_sample.measure()
+            request_measure.start()
+
+            done = False
+            queries = []
+            for l in lines:
                 l = l.decode('utf-8').rstrip()
                 if l == 'END':
-                    self.writer.write('ok\n'.encode('utf-8'))
-                    return
+                    done = True
+                    break
+                queries.append(l.split())
 
-                (method, taskhash) = l.split()
-                #logger.debug('Looking up %s %s' % (method, taskhash))
-                cursor = self.db.cursor()
-                try:
-                    row = self.query_equivalent(cursor, method, taskhash)
-                finally:
-                    cursor.close()
-
-                if row is not None:
-                    msg = ('%s\n' % row['unihash']).encode('utf-8')
-                    #logger.debug('Found equivalent task %s -> %s', (row['taskhash'], row['unihash']))
-                elif self.upstream_client is not None:
-                    upstream = await self.upstream_client.get_unihash(method, taskhash)
-                    if upstream:
-                        msg = ("%s\n" % upstream).encode("utf-8")
-                    else:
-                        msg = "\n".encode("utf-8")
-                else:
-                    msg = '\n'.encode('utf-8')
-
-                self.writer.write(msg)
+            try:
+                upstream = await self.get_unihash_stream(queries)
             finally:
                 request_measure.end()
                 self.request_sample.end()
 
+            if done:
+                self.writer.write('ok\n'.encode('utf-8'))
+                return
+
             await self.writer.drain()
 
             # Post to the backfill queue after writing the result to minimize
             # the turn around time on a request
-            if upstream is not None:
-                await self.backfill_queue.put((method, taskhash))
+            for item in upstream:
+                await self.backfill_queue.put(item)
+
+    async def get_unihash_stream(self, queries):
+        results = self.query_equivalent_batch(queries)
+
+        upstream = []
+        if self.upstream_client is not None:
+            missing = [q for q, r in zip(queries, results) if r is None]
+            if missing:
+                # Send all of the missing hashes to the upstream server at
+                # once instead of waiting on each one in turn
+                upstream_results = iter(await self.upstream_client.get_unihash_batch(missing))
+                for idx, r in enumerate(results):
+                    if r is None:
+                        r = next(upstream_results)
+                        if r is not None:
+                            results[idx] = r
+                            upstream.append(tuple(queries[idx]))
+
+        self.writer.write(''.join('%s\n' % (r or '') for r in results).encode('utf-8'))
+        return upstream
 
     async def handle_report(self, data):
         with closing(self.db.cursor()) as cursor:
@@ -443,7 +541,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             else:
                 unihash = data['unihash']
 
-            self.db.commit()
+            await self.group_commit.commit()
 
             d = {
                 'taskhash': data['taskhash'],
@@ -461,7 +559,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 'unihash': data['unihash'],
             }
             insert_unihash(cursor, insert_data, Resolve.IGNORE)
-            self.db.commit()
+            await self.group_commit.commit()
 
             # Fetch the unihash that will be reported for the taskhash. If the
             # unihash matches, it means this row was inserted (or the mapping
@@ -497,22 +595,67 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             'tasks': self.backfill_queue.qsize(),
         }
         await self.backfill_queue.join()
+        # Make sure the backfilled hashes are visible to other database users
+        await self.group_commit.commit()
         self.write_message(d)
 
     def query_equivalent(self, cursor, method, taskhash):
         # This is part of the inner loop and must be as fast as possible
-        cursor.execute(
-            'SELECT taskhash, method, unihash FROM unihashes_v2 WHERE method=:method AND taskhash=:taskhash',
-            {
-                'method': method,
-                'taskhash': taskhash,
-            }
-        )
-        return cursor.fetchone()
+        unihash = self.unihash_cache.get(method, taskhash)
+        if unihash is None:
+            cursor.execute(
+                'SELECT taskhash, method, unihash FROM unihashes_v2 WHERE method=:method AND taskhash=:taskhash',
+                {
+                    'method': method,
+                    'taskhash': taskhash,
+                }
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            unihash = row['unihash']
+            self.unihash_cache.add(method, taskhash, unihash)
+
+        return {
+            'taskhash': taskhash,
+            'method': method,
+            'unihash': unihash,
+        }
+
+    def query_equivalent_batch(self, queries):
+        # Returns the unihash (or None) of each (method, taskhash) query,
+        # looking up everything that isn't cached with one SELECT per method
+        results = [self.unihash_cache.get(method, taskhash) for method, taskhash in queries]
+
+        missing = {}
+        for (method, taskhash), r in zip(queries, results):
+            if r is None:
+                missing.setdefault(method, set()).add(taskhash)
+
+        if missing:
+            found = {}
+            with closing(self.db.cursor()) as cursor:
+                for method, taskhashes in missing.items():
+                    taskhashes = list(taskhashes)
+                    # Stay well below the sqlite host parameter limit
+                    for i in range(0, len(taskhashes), 500):
+                        chunk = taskhashes[i:i + 500]
+                        cursor.execute(
+                            'SELECT taskhash, unihash FROM unihashes_v2 WHERE method=? AND taskhash IN (%s)' % ','.join('?' * len(chunk)),
+                            [method] + chunk
+                        )
+                        for row in cursor.fetchall():
+                            found[(method, row['taskhash'])] = row['unihash']
+                            self.unihash_cache.add(method, row['taskhash'], row['unihash'])
+
+            results = [r if r is not None else found.get(tuple(q)) for q, r in zip(queries, results)]
+
+        return results
 
 
 class Server(bb.asyncrpc.AsyncServer):
-    def __init__(self, db, upstream=None, read_only=False):
+    def __init__(self, db, upstream=None, read_only=False, commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 unihash_cache_size=DEFAULT_UNIHASH_CACHE_SIZE):
         if upstream and read_only:
             raise bb.asyncrpc.ServerError("Read-only hashserv cannot pull from an upstream server")
 
@@ -522,9 +665,12 @@ class Server(bb.asyncrpc.AsyncServer):
         self.db = db
         self.upstream = upstream
         self.read_only = read_only
+        self.commit_interval = commit_interval
+        self.unihash_cache = UnihashCache(unihash_cache_size)
 
     def accept_client(self, reader, writer):
-        return ServerClient(reader, writer, self.db, self.request_stats, self.backfill_queue, self.upstream, self.read_only)
+        return ServerClient(reader, writer, self.db, self.request_stats, self.backfill_queue, self.upstream, self.read_only,
+                            self.unihash_cache, self.group_commit)
 
     @contextmanager
     def _backfill_worker(self):
@@ -538,6 +684,7 @@ class Server(bb.asyncrpc.AsyncServer):
                         break
                     method, taskhash = item
                     await copy_unihash_from_upstream(client, self.db, method, taskhash)
+                    self.group_commit.schedule()
                     self.backfill_queue.task_done()
             finally:
                 await client.close()
@@ -557,6 +704,11 @@ class Server(bb.asyncrpc.AsyncServer):
 
     def run_loop_forever(self):
         self.backfill_queue = asyncio.Queue()
-
-        with self._backfill_worker():
-            super().run_loop_forever()
+        self.group_commit = GroupCommit(self.db, self.loop, self.commit_interval)
+
+        try:
+            with self._backfill_worker():
+                super().run_loop_forever()
+        finally:
+            # Commit anything still waiting for the commit timer
+            self.group_commit.flush()
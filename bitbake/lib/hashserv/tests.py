@@ -18,6 +18,8 @@ import socket
 import time
 import signal
 
+logger = logging.getLogger('BitBake.TestHashserv')
+
 def server_prefunc(server, idx):
     logging.basicConfig(level=logging.DEBUG, filename='bbhashserv-%d.log' % idx, filemode='w',
                         format='%(levelname)s %(filename)s:%(lineno)d %(message)s')
@@ -152,6 +154,28 @@ class HashEquivalenceCommonTests(object):
         self.assertEqual(result_outhash['outhash'], outhash)
         self.assertEqual(result_outhash['outhash_siginfo'], siginfo)
 
+    def test_get_unihash_batch(self):
+        taskhashes = []
+        for i in range(600):
+            taskhash = hashlib.sha256()
+            taskhash.update(str(i).encode('utf-8'))
+            taskhashes.append(taskhash.hexdigest())
+
+        # Only report every other hash so that hits and misses are mixed in
+        # each batch
+        for taskhash in taskhashes[::2]:
+            self.client.report_unihash(taskhash, self.METHOD, taskhash, taskhash)
+
+        result = self.client.get_unihash_batch((self.METHOD, t) for t in taskhashes)
+        self.assertEqual(result, [t if i % 2 == 0 else None for i, t in enumerate(taskhashes)])
+
+        # The cached mappings must give the same answers, and normal requests
+        # must still work after the stream
+        result = self.client.get_unihash_batch((self.METHOD, t) for t in taskhashes)
+        self.assertEqual(result, [t if i % 2 == 0 else None for i, t in enumerate(taskhashes)])
+        self.assertClientGetHash(self.client, taskhashes[0], taskhashes[0])
+        self.assertEqual(self.client.get_taskhash(self.METHOD, taskhashes[2])['unihash'], taskhashes[2])
+
     def test_stress(self):
         def query_server(failures):
             client = Client(self.server.address)
@@ -241,6 +265,14 @@ class HashEquivalenceCommonTests(object):
 
         check_hash(taskhash3, unihash, None)
 
+        # Batched lookups on the downstream server fall back to the upstream
+        # server for the hashes it doesn't have
+        self.assertEqual(down_client.get_unihash_batch([
+            (self.METHOD, taskhash),
+            (self.METHOD, '0000000000000000000000000000000000000000'),
+            (self.METHOD, taskhash3),
+        ]), [unihash, None, unihash])
+
         # Test that reporting a unihash in the downstream client isn't
         # propagating to the upstream server
         taskhash4 = "e3da00593d6a7fb435c7e2114976c59c5fd6d561"
@@ -431,3 +463,81 @@ class TestHashEquivalenceTCPServer(HashEquivalenceTestSetup, HashEquivalenceComm
         # If IPv6 is enabled, it should be safe to use localhost directly, in general
         # case it is more reliable to resolve the IP address explicitly.
         return socket.gethostbyname("localhost") + ":0"
+
+
+@unittest.skipUnless(os.environ.get('HASHSERV_BENCHMARK_SCALE'), 'HASHSERV_BENCHMARK_SCALE not set')
+class TestHashEquivalenceBenchmark(HashEquivalenceTestSetup, unittest.TestCase):
+    # Logs the request rate of the server under concurrent clients,
+    # HASHSERV_BENCHMARK_SCALE multiplies the number of clients and hashes
+    SCALE = int(os.environ.get('HASHSERV_BENCHMARK_SCALE', '1'))
+    CLIENTS = 10
+    HASHES = 200
+
+    def get_server_addr(self, server_idx):
+        return "unix://" + os.path.join(self.temp_dir.name, 'sock%d' % server_idx)
+
+    def run_clients(self, name, func):
+        failures = []
+        count = 0
+        lock = threading.Lock()
+
+        def run(idx):
+            nonlocal count
+            client = create_client(self.server.address)
+            try:
+                n = func(client, idx, failures)
+                with lock:
+                    count += n
+            except Exception as e:
+                failures.append(str(e))
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=run, args=(idx,)) for idx in range(self.CLIENTS * self.SCALE)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        self.assertFalse(failures, name)
+        self.assertEqual(count, len(threads) * self.HASHES * self.SCALE, name)
+        logger.info("%s: %d requests from %d clients in %.2fs (%.0f requests/s)" %
+                    (name, count, len(threads), elapsed, count / elapsed))
+
+    def taskhashes(self, idx):
+        for i in range(self.HASHES * self.SCALE):
+            taskhash = hashlib.sha256()
+            taskhash.update(('%d-%d' % (idx, i)).encode('utf-8'))
+            yield taskhash.hexdigest()
+
+    def test_benchmark(self):
+        def report(client, idx, failures):
+            n = 0
+            for taskhash in self.taskhashes(idx):
+                result = client.report_unihash(taskhash, self.METHOD, taskhash, taskhash)
+                if result['unihash'] != taskhash:
+                    failures.append("report mismatch: %s != %s" % (result['unihash'], taskhash))
+                n += 1
+            return n
+
+        def get(client, idx, failures):
+            n = 0
+            for taskhash in self.taskhashes(idx):
+                result = client.get_unihash(self.METHOD, taskhash)
+                if result != taskhash:
+                    failures.append("taskhash mismatch: %s != %s" % (result, taskhash))
+                n += 1
+            return n
+
+        def get_batch(client, idx, failures):
+            taskhashes = list(self.taskhashes(idx))
+            result = client.get_unihash_batch((self.METHOD, t) for t in taskhashes)
+            if result != taskhashes:
+                failures.append("batch mismatch for client %d" % idx)
+            return len(taskhashes)
+
+        self.run_clients("report", report)
+        self.run_clients("get", get)
+        self.run_clients("get-batch", get_batch)
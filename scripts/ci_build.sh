@@ -50,6 +50,8 @@ show_help() {
     echo "                             the tests will be started in current path."
     echo "    -d, --debug              enable debug bitbake output."
     echo "    -T, --tags               specify basic avocado tags."
+    echo "    -j, --shards N           run the tests in N parallel shards with"
+    echo "                             separate build dirs below BASE_DIR."
     echo "    --help                   display this message and exit."
     echo
     echo "Exit status:"
@@ -78,6 +80,10 @@ do
         TAGS="$2"
         shift
         ;;
+    -j|--shards)
+        SHARDS="$2"
+        shift
+        ;;
     -S|--sstate)
         SSTATE="-p sstate=$2"
         shift
@@ -145,6 +151,12 @@ export VIRTUAL_ENV="./"
 # the real stuff starts here, trace commands from now on
 set -x
 
+if [ -n "$SHARDS" ]; then
+    # shellcheck disable=SC2086
+    exec "${TESTSUITE_DIR}/cishard.py" -t "${TAGS}" -j "${SHARDS}" \
+        -b "$(realpath "${BASE_DIR}")" --disable-sysinfo ${SSTATE} ${TIMEOUT}
+fi
+
 avocado ${VERBOSE} run "${TESTSUITE_DIR}/citest.py" \
     -t "${TAGS}" --max-parallel-tasks=1 --disable-sysinfo \
     ${SSTATE} ${TIMEOUT}
@@ -23,6 +23,7 @@ import shutil
 import re
 
 from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 from wic import WicError
 from wic.filemap import sparse_copy
@@ -231,6 +232,9 @@ class Disk:
         self._lsector_size = None
         self._psector_size = None
         self._ptable_format = None
+        self._session = False
+        self._dirty = set()
+        self._debugfs_cmds = {}
 
         # find parted
         # read paths from $PATH environment variable
@@ -310,12 +314,68 @@ class Disk:
 
     def _put_part_image(self, pnum):
         """Put partition image into partitioned image."""
+        if self._session:
+            self._dirty.add(pnum)
+            return
         sparse_copy(self._partimages[pnum], self.imagepath,
                     seek=self.partitions[pnum].start)
 
+    def _flush_debugfs(self, pnum):
+        """Run the debugfs commands queued for partition pnum in one go."""
+        cmds = self._debugfs_cmds.pop(pnum, None)
+        if not cmds:
+            return
+        with tempfile.NamedTemporaryFile(prefix="wic-debugfs-", mode='w') as cmdf:
+            cmdf.write("".join(cmds))
+            cmdf.flush()
+            out = exec_cmd("{} -w -f {} {}".format(self.debugfs, cmdf.name,
+                                                  self._get_part_image(pnum)))
+        for line in out.splitlines():
+            if line.split(':')[0] in ("cd", "write"):
+                raise WicError("Could not complete operation on partition "
+                               "%s: \n%s" % (pnum, line))
+
+    def start_session(self):
+        """
+        Start a session: partitions are extracted once and written back by
+        commit() only, writes to ext* partitions are applied with one
+        debugfs call per partition.
+        """
+        self._session = True
+
+    def commit(self):
+        """Apply the changes of the session to the image and end it."""
+        for pnum in list(self._debugfs_cmds):
+            self._flush_debugfs(pnum)
+        self._session = False
+        for pnum in sorted(self._dirty):
+            self._put_part_image(pnum)
+        self._dirty.clear()
+
+    def abort(self):
+        """End the session, leaving the image unchanged."""
+        self._session = False
+        self._dirty.clear()
+        self._debugfs_cmds.clear()
+        for path in self._partimages.values():
+            os.unlink(path)
+        self._partimages.clear()
+
+    @contextmanager
+    def session(self):
+        """Batch all operations of the with block, see start_session()."""
+        self.start_session()
+        try:
+            yield self
+        except BaseException:
+            self.abort()
+            raise
+        self.commit()
+
     def dir(self, pnum, path):
         if pnum not in self.partitions:
             raise WicError("Partition %s is not in the image" % pnum)
+        self._flush_debugfs(pnum)
 
         if self.partitions[pnum].fstype.startswith('ext'):
             return exec_cmd("{} {} -R 'ls -l {}'".format(self.debugfs,
@@ -329,8 +389,16 @@ class Disk:
     def copy(self, src, dest):
         """Copy partition image into wic image."""
         pnum =  dest.part if isinstance(src, str) else src.part
+        self._flush_debugfs(pnum)
 
         if self.partitions[pnum].fstype.startswith('ext'):
+            if isinstance(src, str) and self._session:
+                self._get_part_image(pnum)
+                self._debugfs_cmds.setdefault(pnum, []).append(
+                    "cd {}\nwrite {} {}\n".format(os.path.dirname(dest.path),
+                                                  src, os.path.basename(src)))
+                self._put_part_image(pnum)
+                return
             if isinstance(src, str):
                 cmd = "printf 'cd {}\nwrite {} {}\n' | {} -w {}".\
                       format(os.path.dirname(dest.path), src, os.path.basename(src),
@@ -397,6 +465,7 @@ class Disk:
     def remove(self, pnum, path, recursive):
         """Remove files/dirs from the partition."""
         partimg = self._get_part_image(pnum)
+        self._flush_debugfs(pnum)
         if self.partitions[pnum].fstype.startswith('ext'):
             self.remove_ext(pnum, path, recursive)
 
@@ -417,6 +486,8 @@ class Disk:
 
     def write(self, target, expand):
         """Write disk image to the media or file."""
+        if self._session:
+            raise WicError("Commit the session before writing the image")
         def write_sfdisk_script(outf, parts):
             for key, val in parts['partitiontable'].items():
                 if key in ("partitions", "device", "firstlba", "lastlba"):
@@ -554,9 +625,19 @@ class Disk:
                 elif part['type'] != 'f':
                     logger.warning("skipping partition {}: unsupported fstype {}".format(pnum, fstype))
 
-def wic_ls(args, native_sysroot):
+def _get_disk(image, native_sysroot, disks):
+    """Return a new Disk, or the one of a batch session if disks is set."""
+    if disks is None:
+        return Disk(image, native_sysroot)
+    key = os.path.realpath(image)
+    if key not in disks:
+        disks[key] = Disk(image, native_sysroot)
+        disks[key].start_session()
+    return disks[key]
+
+def wic_ls(args, native_sysroot, disks=None):
     """List contents of partitioned image or vfat partition."""
-    disk = Disk(args.path.image, native_sysroot)
+    disk = _get_disk(args.path.image, native_sysroot, disks)
     if not args.path.part:
         if disk.partitions:
             print('Num     Start        End          Size      Fstype')
@@ -568,33 +649,57 @@ def wic_ls(args, native_sysroot):
         path = args.path.path or '/'
         print(disk.dir(args.path.part, path))
 
-def wic_cp(args, native_sysroot):
+def wic_cp(args, native_sysroot, disks=None):
     """
     Copy file or directory to/from the vfat/ext partition of
     partitioned image.
     """
     if isinstance(args.dest, str):
-        disk = Disk(args.src.image, native_sysroot)
+        disk = _get_disk(args.src.image, native_sysroot, disks)
     else:
-        disk = Disk(args.dest.image, native_sysroot)
+        disk = _get_disk(args.dest.image, native_sysroot, disks)
     disk.copy(args.src, args.dest)
 
 
-def wic_rm(args, native_sysroot):
+def wic_rm(args, native_sysroot, disks=None):
     """
     Remove files or directories from the vfat partition of
     partitioned image.
     """
-    disk = Disk(args.path.image, native_sysroot)
+    disk = _get_disk(args.path.image, native_sysroot, disks)
     disk.remove(args.path.part, args.path.path, args.recursive_delete)
 
-def wic_write(args, native_sysroot):
+def wic_write(args, native_sysroot, disks=None):
     """
     Write image to a target device.
     """
+    if disks is not None:
+        # apply the pending changes of the batch to the image first
+        disk = disks.pop(os.path.realpath(args.image), None)
+        if disk:
+            disk.commit()
     disk = Disk(args.image, native_sysroot, ('fat', 'ext', 'linux-swap'))
     disk.write(args.target, args.expand)
 
+def wic_batch(commands, native_sysroot):
+    """
+    Run a list of parsed ls/cp/rm/write commands, extracting every touched
+    partition once and writing it back once at the end. If a command fails,
+    the images are left unchanged (except for writes already done).
+    """
+    disks = OrderedDict()
+    funcs = {"ls": wic_ls, "cp": wic_cp, "rm": wic_rm, "write": wic_write}
+    try:
+        for args in commands:
+            funcs[args.command](args, args.native_sysroot or native_sysroot,
+                                disks)
+    except BaseException:
+        for disk in disks.values():
+            disk.abort()
+        raise
+    for disk in disks.values():
+        disk.commit()
+
 def find_canned(scripts_path, file_name):
     """
     Find a file either by its path or by name in the canned files dir.
@@ -18,6 +18,7 @@ and returns an instance of the class.
 # pylint: disable=R0902
 
 import errno
+import hashlib
 import os
 import struct
 import array
@@ -510,11 +511,87 @@ def filemap(image, log=None):
         except ErrorNotSupp:
             return FilemapNobmap(image, log)
 
+# The FICLONERANGE ioctl, cloning a range of one file into another on
+# file-systems supporting reflinks (btrfs, xfs)
+_FICLONERANGE = 0x4020940d
+
+class _RangeCopier(object):
+    """
+    Copy byte ranges between two files, preferring reflinks (FICLONERANGE) if
+    both are on the same file-system, then in-kernel copies (copy_file_range),
+    and falling back to reading and writing in user space.
+    """
+
+    def __init__(self, src_file, dst_file, block_size):
+        self._src = src_file.fileno()
+        self._dst = dst_file.fileno()
+        self._block_size = block_size
+        self._src_size = os.fstat(self._src).st_size
+        self._clone = os.fstat(self._src).st_dev == os.fstat(self._dst).st_dev
+        self._copy_file_range = hasattr(os, 'copy_file_range')
+
+    def _try_clone(self, src_off, dst_off, size):
+        bsize = self._block_size
+        if src_off % bsize or dst_off % bsize or \
+           (size % bsize and src_off + size != self._src_size):
+            return False
+        try:
+            fcntl.ioctl(self._dst, _FICLONERANGE,
+                        struct.pack('qQQQ', self._src, src_off, size, dst_off))
+            return True
+        except OSError as err:
+            # EINVAL only concerns this range (e.g. unaligned end of file)
+            if err.errno != errno.EINVAL:
+                self._clone = False
+            return False
+
+    def _try_copy_file_range(self, src_off, dst_off, size):
+        """Return the number of bytes copied before falling back."""
+        copied = 0
+        try:
+            while copied < size:
+                ret = os.copy_file_range(self._src, self._dst, size - copied,
+                                         src_off + copied, dst_off + copied)
+                if not ret:
+                    break
+                copied += ret
+        except OSError as err:
+            if err.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                 errno.EOPNOTSUPP, errno.EPERM):
+                raise
+            self._copy_file_range = False
+        return copied
+
+    def copy(self, src_off, dst_off, size):
+        if self._clone and self._try_clone(src_off, dst_off, size):
+            return
+
+        if self._copy_file_range:
+            copied = self._try_copy_file_range(src_off, dst_off, size)
+            if copied == size or self._copy_file_range:
+                return
+            src_off += copied
+            dst_off += copied
+            size -= copied
+
+        chunk_size = 1024 * 1024
+        while size > 0:
+            chunk = os.pread(self._src, min(chunk_size, size), src_off)
+            if not chunk:
+                break
+            os.pwrite(self._dst, chunk, dst_off)
+            src_off += len(chunk)
+            dst_off += len(chunk)
+            size -= len(chunk)
+
 def sparse_copy(src_fname, dst_fname, skip=0, seek=0,
                 length=0, api=None):
     """
     Efficiently copy sparse file to or into another file.
 
+    Only the mapped ranges of the source are copied, by reflinking or by
+    copying them in the kernel where possible.
+
     src_fname: path to source file
     dst_fname: path to destination file
     skip: skip N bytes at thestart of src
@@ -535,42 +612,66 @@ def sparse_copy(src_fname, dst_fname, skip=0, seek=0,
             dst_size = os.path.getsize(src_fname) + seek - skip
         dst_file.truncate(dst_size)
 
-    written = 0
-    for first, last in fmap.get_mapped_ranges(0, fmap.blocks_cnt):
-        start = first * fmap.block_size
-        end = (last + 1) * fmap.block_size
-
-        if skip >= end:
-            continue
-
-        if start < skip < end:
-            start = skip
+    src_end = min(skip + length, fmap.image_size) if length else fmap.image_size
+    copier = _RangeCopier(fmap._f_image, dst_file, fmap.block_size)
 
-        fmap._f_image.seek(start, os.SEEK_SET)
+    with dst_file:
+        for first, last in fmap.get_mapped_ranges(0, fmap.blocks_cnt):
+            start = max(first * fmap.block_size, skip)
+            end = min((last + 1) * fmap.block_size, src_end)
+            if start >= src_end:
+                break
+            if start < end:
+                copier.copy(start, seek + start - skip, end - start)
 
-        written += start - skip - written
-        if length and written >= length:
-            dst_file.seek(seek + length, os.SEEK_SET)
-            dst_file.close()
-            return
+def write_bmap(image, bmap_fname, api=None):
+    """
+    Write a bmaptool compatible block map of file 'image' to 'bmap_fname',
+    so that flashing the image only writes its mapped blocks.
 
-        dst_file.seek(seek + start - skip, os.SEEK_SET)
+    The block map is taken from the same range map sparse_copy uses. Each
+    range gets a SHA256 checksum, the file itself is protected by the
+    BmapFileChecksum as defined by the bmap format 2.0.
+    """
+    if not api:
+        api = filemap
+    fmap = api(image)
+    fd = fmap._f_image.fileno()
 
-        chunk_size = 1024 * 1024
-        to_read = end - start
-        read = 0
-
-        while read < to_read:
-            if read + chunk_size > to_read:
-                chunk_size = to_read - read
-            size = chunk_size
-            if length and written + size > length:
-                size = length - written
-            chunk = fmap._f_image.read(size)
-            dst_file.write(chunk)
-            read += size
-            written += size
-            if written == length:
-                dst_file.close()
-                return
-    dst_file.close()
+    ranges = []
+    mapped_cnt = 0
+    for first, last in fmap.get_mapped_ranges(0, fmap.blocks_cnt):
+        chksum = hashlib.sha256()
+        pos = first * fmap.block_size
+        end = min((last + 1) * fmap.block_size, fmap.image_size)
+        while pos < end:
+            chunk = os.pread(fd, min(1024 * 1024, end - pos), pos)
+            if not chunk:
+                break
+            chksum.update(chunk)
+            pos += len(chunk)
+
+        blocks = "%d-%d" % (first, last) if last != first else "%d" % first
+        ranges.append('        <Range chksum="%s"> %s </Range>\n'
+                      % (chksum.hexdigest(), blocks))
+        mapped_cnt += last - first + 1
+
+    placeholder = "0" * hashlib.sha256().digest_size * 2
+    xml = ('<?xml version="1.0" ?>\n'
+           '<bmap version="2.0">\n'
+           '    <ImageSize> %d </ImageSize>\n'
+           '    <BlockSize> %d </BlockSize>\n'
+           '    <BlocksCount> %d </BlocksCount>\n'
+           '    <MappedBlocksCount> %d </MappedBlocksCount>\n'
+           '    <ChecksumType> sha256 </ChecksumType>\n'
+           '    <BmapFileChecksum> %s </BmapFileChecksum>\n'
+           '    <BlockMap>\n'
+           '%s'
+           '    </BlockMap>\n'
+           '</bmap>\n'
+           % (fmap.image_size, fmap.block_size, fmap.blocks_cnt, mapped_cnt,
+              placeholder, ''.join(ranges)))
+    xml = xml.replace(placeholder, hashlib.sha256(xml.encode()).hexdigest(), 1)
+
+    with open(bmap_fname, 'w') as bmap_file:
+        bmap_file.write(xml)
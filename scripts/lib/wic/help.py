@@ -511,6 +511,53 @@ DESCRIPTION
     containing the tools(parted, resize2fs) to use.
 """
 
+wic_batch_usage = """
+
+ Run ls, cp, rm and write commands from a file
+
+ usage: wic batch <commands file> [--native-sysroot <path>]
+
+ This command runs the wic commands listed in a file, extracting and writing
+ back every modified partition only once.
+
+ See 'wic help batch' for more detailed instructions.
+
+"""
+
+wic_batch_help = """
+
+NAME
+    wic batch - run ls, cp, rm and write commands from a file
+
+SYNOPSIS
+    wic batch <commands file>
+    wic batch <commands file> --native-sysroot <path>
+
+DESCRIPTION
+    This command runs a list of 'wic ls', 'wic cp', 'wic rm' and 'wic write'
+    commands, one per line without the leading 'wic'. Empty lines and
+    comments starting with '#' are ignored:
+
+        $ cat commands.txt
+        # inject configuration into the rootfs partition
+        cp hostname ./image.wic:2/etc/
+        cp sshd_config ./image.wic:2/etc/ssh/
+        rm ./image.wic:1/libutil.c32
+        $ wic batch commands.txt
+
+    Unlike running the commands one by one, every partition is extracted
+    from the image once, all operations are applied to it, and it is written
+    back once at the end. Copies into ext* partitions are applied with a
+    single debugfs call per partition. A 'write' command writes the changes
+    made so far.
+
+    All lines are parsed before the first command runs. If a command fails,
+    the image is left unchanged.
+
+    The -n option is used to specify the path to the native sysroot
+    containing the tools(parted, mtools and debugfs) to use.
+"""
+
 wic_plugins_help = """
 
 NAME
@@ -1112,6 +1159,7 @@ COMMAND:
     help   -   Show help for a wic COMMAND or TOPIC
     write  -   Write an image to a device
     cp     -   Copy files and directories to the vfat or ext* partitions
+    batch  -   Run ls, cp, rm and write commands from a file
     create -   Create a new OpenEmbedded image
 
 
@@ -10,8 +10,10 @@
 # Tom Zanussi <tom.zanussi (at] linux.intel.com>
 # Ed Bartosh <ed.bartosh> (at] linux.intel.com>
 
+import hashlib
 import logging
 import os
+import stat
 import uuid
 
 from wic import WicError
@@ -62,6 +64,7 @@ class Partition():
 
         self.lineno = lineno
         self.source_file = ""
+        self.cached_rootfs = None
 
     def get_extra_block_count(self, current_blocks):
         """
@@ -200,6 +203,97 @@ class Partition():
                            "larger (%d kB) than its allowed size %d kB" %
                            (self.mountpoint, self.size, self.fixed_size))
 
+    def get_mkfs_version(self, native_sysroot):
+        """
+        Return the version output of the tool creating the filesystem.
+        """
+        if self.fstype == "squashfs":
+            cmd = "mksquashfs -version"
+        else:
+            cmd = "mkfs.%s -V" % self.fstype
+        # mkfs.vfat has no version option but prints its version with the
+        # usage, ignore the exit code
+        return exec_native_cmd("%s || true" % cmd, native_sysroot)[1]
+
+    def get_rootfs_cache(self, rootfs_dir, pseudo_dir, native_sysroot, *extra):
+        """
+        Return the path of the cached filesystem image for 'rootfs_dir' in
+        WIC_PARTITION_CACHE_DIR, or None if caching is disabled.
+
+        The key covers the content manifest of the rootfs (paths, modes,
+        owners, timestamps, extended attributes, hard links and content
+        digests), the mkfs version and parameters, the partition size,
+        DISTRO and SOURCE_DATE_EPOCH. The rootfs timestamps are clamped to
+        SOURCE_DATE_EPOCH, so only their clamped value goes into the key.
+        Without SOURCE_DATE_EPOCH every rebuilt rootfs gets a new key.
+        """
+        cache_dir = get_bitbake_var("WIC_PARTITION_CACHE_DIR")
+        if not cache_dir:
+            return None
+
+        key = hashlib.sha256()
+        def add(*fields):
+            key.update(repr(fields).encode())
+
+        add(self.fstype, self.label, self.mkfs_extraopts, self.size,
+            self.fixed_size, self.extra_space, self.overhead_factor,
+            get_bitbake_var("DISTRO"), os.environ.get("SOURCE_DATE_EPOCH"),
+            self.get_mkfs_version(native_sysroot), *extra)
+
+        # Owners are recorded by pseudo, not in the rootfs
+        if pseudo_dir and os.path.exists(os.path.join(pseudo_dir, "files.db")):
+            with open(os.path.join(pseudo_dir, "files.db"), 'rb') as f:
+                add(hashlib.sha256(f.read()).hexdigest())
+
+        sde = os.environ.get("SOURCE_DATE_EPOCH")
+        max_mtime = int(sde) * 10**9 if sde else None
+
+        inodes = {}
+        for root, dirs, files in os.walk(rootfs_dir):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, rootfs_dir)
+                st = os.lstat(path)
+                try:
+                    xattrs = sorted((x, os.getxattr(path, x, follow_symlinks=False))
+                                    for x in os.listxattr(path, follow_symlinks=False))
+                except OSError:
+                    xattrs = None
+                mtime = st.st_mtime_ns
+                if max_mtime is not None:
+                    mtime = min(mtime, max_mtime)
+                add(rel, st.st_mode, st.st_uid, st.st_gid, mtime, xattrs)
+
+                if stat.S_ISLNK(st.st_mode):
+                    add(os.readlink(path))
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    add(st.st_rdev)
+                elif stat.S_ISREG(st.st_mode):
+                    if st.st_nlink > 1:
+                        inode = (st.st_dev, st.st_ino)
+                        if inode in inodes:
+                            add("link", inodes[inode])
+                            continue
+                        inodes[inode] = rel
+                    digest = hashlib.sha256()
+                    with open(path, 'rb') as f:
+                        for block in iter(lambda: f.read(1024 * 1024), b''):
+                            digest.update(block)
+                    add(digest.hexdigest())
+
+        return os.path.join(cache_dir, "%s.%s" % (key.hexdigest(), self.fstype))
+
+    def store_rootfs_cache(self, rootfs):
+        """Store the filesystem image 'rootfs' under self.cached_rootfs."""
+        if not self.cached_rootfs:
+            return
+        cache_dir = os.path.dirname(self.cached_rootfs)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = "%s.%d.tmp" % (self.cached_rootfs, os.getpid())
+        exec_cmd("cp --reflink=auto --sparse=always %s %s" % (rootfs, tmp))
+        os.rename(tmp, self.cached_rootfs)
+
     def prepare_rootfs(self, cr_workdir, oe_builddir, rootfs_dir,
                        native_sysroot, real_rootfs = True, pseudo_dir = None):
         """
@@ -255,8 +349,34 @@ class Partition():
                 self.size = int(out.split()[0])
 
         prefix = "ext" if self.fstype.startswith("ext") else self.fstype
-        method = getattr(self, "prepare_rootfs_" + prefix)
-        method(rootfs, cr_workdir, oe_builddir, rootfs_dir, native_sysroot, pseudo)
+
+        # ext images are cached before their UUID and fstab are set, the
+        # other types have them built in. Without a fixed --fsuuid, their
+        # UUID is random and a cached image would never be used again.
+        extra = ()
+        if prefix != "ext":
+            extra = (self.fsuuid if prefix != "squashfs" else None,)
+            if self.updated_fstab_path and self.has_fstab and not self.no_fstab_update:
+                with open(self.updated_fstab_path) as f:
+                    extra += (f.read(),)
+        if prefix in ("ext", "squashfs") or self.args.fsuuid:
+            self.cached_rootfs = self.get_rootfs_cache(rootfs_dir, pseudo_dir,
+                                                       native_sysroot, *extra)
+
+        if self.cached_rootfs and os.path.exists(self.cached_rootfs):
+            logger.info("Using cached partition image %s for %s",
+                        self.cached_rootfs, self.mountpoint)
+            exec_cmd("cp --reflink=auto --sparse=always %s %s" %
+                     (self.cached_rootfs, rootfs))
+            if prefix == "ext":
+                exec_native_cmd("tune2fs -U %s %s" % (self.fsuuid, rootfs),
+                                native_sysroot)
+                self.finish_rootfs_ext(rootfs, cr_workdir, native_sysroot, pseudo)
+        else:
+            method = getattr(self, "prepare_rootfs_" + prefix)
+            method(rootfs, cr_workdir, oe_builddir, rootfs_dir, native_sysroot, pseudo)
+            if prefix != "ext":
+                self.store_rootfs_cache(rootfs)
         self.source_file = rootfs
 
         # get the rootfs size in the right units for kickstart (kB)
@@ -288,6 +408,13 @@ class Partition():
             (self.fstype, extraopts, rootfs, label_str, self.fsuuid, rootfs_dir)
         exec_native_cmd(mkfs_cmd, native_sysroot, pseudo=pseudo)
 
+        self.store_rootfs_cache(rootfs)
+        self.finish_rootfs_ext(rootfs, cr_workdir, native_sysroot, pseudo)
+
+    def finish_rootfs_ext(self, rootfs, cr_workdir, native_sysroot, pseudo):
+        """
+        Update the fstab of an ext2/3/4 rootfs partition and check it.
+        """
         if self.updated_fstab_path and self.has_fstab and not self.no_fstab_update:
             debugfs_script_path = os.path.join(cr_workdir, "debugfs_script")
             with open(debugfs_script_path, "w") as f:
@@ -11,17 +11,17 @@
 # Joao Henrique Ferreira de Freitas <joaohf (at] gmail.com>
 #
 
+import errno
 import logging
 import os
 import shutil
 import sys
 
-from oe.path import copyhardlinktree
 from pathlib import Path
 
 from wic import WicError
 from wic.pluginbase import SourcePlugin
-from wic.misc import get_bitbake_var, exec_native_cmd
+from wic.misc import get_bitbake_var, exec_cmd, exec_native_cmd
 
 logger = logging.getLogger('wic')
 
@@ -61,6 +61,65 @@ class RootfsPlugin(SourcePlugin):
 
         return os.path.realpath(image_rootfs_dir)
 
+    @staticmethod
+    def __stage_rootfs(src, dst, excludes, cr_workdir):
+        """
+        Make a tree of hard links of 'src' in 'dst', leaving out the paths
+        excluded by --exclude-path. 'excludes' maps relative paths to True if
+        only their content is to be left out. The file list is built in one
+        pass over 'src', so excluded trees are never copied nor deleted.
+        """
+        dirs = ['.']
+        files = []
+        for root, dirnames, filenames in os.walk(src):
+            rel_root = os.path.relpath(root, src)
+            if excludes.get(rel_root):
+                dirnames[:] = []
+                continue
+
+            subdirs = []
+            for name in dirnames:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                if rel in excludes and not excludes[rel]:
+                    continue
+                if os.path.islink(os.path.join(root, name)):
+                    files.append(rel)
+                else:
+                    dirs.append(rel)
+                    subdirs.append(name)
+            dirnames[:] = subdirs
+
+            for name in filenames:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                if rel not in excludes:
+                    files.append(rel)
+
+        os.makedirs(dst)
+
+        def tar_copy(paths):
+            listfile = os.path.join(cr_workdir, "stage-rootfs.list")
+            with open(listfile, 'w') as f:
+                f.write('\0'.join(paths))
+            tar_cmd = "tar --xattrs --xattrs-include='*' -cf - -C %s -p " \
+                      "--no-recursion --null --files-from %s | " \
+                      "tar --xattrs --xattrs-include='*' -xhf - -C %s" % \
+                      (src, listfile, dst)
+            exec_cmd(tar_cmd, as_shell=True)
+            os.remove(listfile)
+
+        # Directories are copied with their metadata, files are hard-linked
+        # unless 'dst' is on another file-system
+        tar_copy(dirs)
+        for i, rel in enumerate(files):
+            try:
+                os.link(os.path.join(src, rel), os.path.join(dst, rel),
+                        follow_symlinks=False)
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EPERM):
+                    raise
+                tar_copy(files[i:])
+                break
+
     @staticmethod
     def __get_pseudo(native_sysroot, rootfs, pseudo_dir):
         pseudo = "export PSEUDO_PREFIX=%s/usr;" % native_sysroot
@@ -122,7 +181,13 @@ class RootfsPlugin(SourcePlugin):
                 orig_dir = cls.__validate_path("--change-directory", part.rootfs_dir, cd)
             else:
                 orig_dir = part.rootfs_dir
-            copyhardlinktree(orig_dir, new_rootfs)
+
+            excludes = {}
+            for path in part.exclude_path or []:
+                full_path = cls.__validate_path("--exclude-path", orig_dir, path)
+                rel = os.path.relpath(full_path, os.path.realpath(orig_dir))
+                excludes[rel] = path.endswith(os.sep)
+            cls.__stage_rootfs(orig_dir, new_rootfs, excludes, cr_workdir)
 
             # Convert the pseudo directory to its new location
             if (pseudo_dir):
@@ -195,6 +260,8 @@ class RootfsPlugin(SourcePlugin):
                 exec_native_cmd(untar_cmd, native_sysroot, pseudo)
                 os.remove(tar_file)
 
+            # Excluded paths were not staged, this only removes what the
+            # included paths added back
             for orig_path in part.exclude_path or []:
                 path = orig_path
 
@@ -46,10 +46,14 @@ class CIBaseTest(CIBuilder):
             self.bitbake(targets, **kwargs)
 
             self.delete_from_build_dir('tmp')
-            self.configure(gpg_pub_key=gpg_pub_key if signed else None, offline=True, sstate_dir="", **kwargs)
+            self.configure(gpg_pub_key=gpg_pub_key if signed else None, offline=True, sstate_dir="",
+                           buildstats=signed, **kwargs)
 
             self.bitbake(targets, **kwargs)
 
+            if signed:
+                self.check_signed_repo('base-apt')
+
             # Disable use of cached base repository
             self.unconfigure()
 
@@ -63,6 +67,23 @@ class CIBaseTest(CIBuilder):
             process.run('gpgconf --kill gpg-agent')
             shutil.rmtree(gnupg_home, True)
 
+    def check_signed_repo(self, recipe):
+        # time spent in populating (and signing) the repo, for comparison
+        # between runs
+        for stats in glob.glob(f'{self.build_dir}/tmp/buildstats/*/{recipe}-*/do_cache'):
+            with open(stats) as f:
+                for line in f:
+                    if line.startswith('Elapsed time:'):
+                        self.log.info(f'{recipe} do_cache: {line.split(":", 1)[1].strip()}')
+
+        releases = glob.glob(f'{self.build_dir}/tmp/deploy/{recipe}/*/apt/*/dists/*/InRelease')
+        if not releases:
+            self.fail(f'No signed {recipe} repository found')
+        for release in releases:
+            result = process.run(f'gpg --verify {release}', ignore_status=True)
+            if result.exit_status:
+                self.fail(f'Invalid signature of {release}')
+
     def perform_ccache_test(self, targets, **kwargs):
         def ccache_stats(dir, field):
             # Look ccache source's 'src/core/Statistic.hpp' for field meanings
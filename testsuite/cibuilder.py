@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
+import asyncio
+import concurrent.futures
+import json
 import logging
 import os
 import pickle
 import re
-import select
 import shutil
 import signal
+import socket
 import subprocess
 import time
 import tempfile
@@ -18,6 +21,9 @@ from avocado.utils import path
 from avocado.utils import process
 
 DEF_VM_TO_SEC = 600
+# CPUs kept busy by one emulated VM (vCPU and I/O thread)
+VM_CPUS = 2
+VM_SNAPSHOT = 'boot'
 
 isar_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 backup_prefix = '.ci-backup'
@@ -27,6 +33,72 @@ app_log = logging.getLogger("avocado.app")
 class CanBeFinished(Exception):
     pass
 
+async def _drain_pipe(pipe, handler, marker, found):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    # read from a duplicate so that the pipe stays open for the process
+    # when we stop reading, e.g. after the login prompt of a VM
+    fd = os.dup(pipe.fileno())
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    partial = b''
+    tail = b''
+    try:
+        while True:
+            data = await reader.read(1 << 16)
+            if not data:
+                break
+            if marker:
+                # keep the end of the previous chunk to find split markers
+                window = tail + data
+                if marker in window and not found.done():
+                    found.set_result(True)
+                tail = window[-(len(marker) - 1):] if len(marker) > 1 else b''
+            # pass all complete lines at once
+            lines, newline, partial = (partial + data).rpartition(b'\n')
+            if newline and handler:
+                handler(lines.decode(errors='replace'))
+    finally:
+        if partial and handler:
+            handler(partial.decode(errors='replace'))
+        transport.close()
+        os.set_blocking(pipe.fileno(), True)
+
+async def _stream_output(p1, stdout_handler, stderr_handler, marker, timeout):
+    loop = asyncio.get_running_loop()
+    found = loop.create_future()
+    drains = [loop.create_task(_drain_pipe(p1.stdout, stdout_handler, marker, found)),
+              loop.create_task(_drain_pipe(p1.stderr, stderr_handler, None, found))]
+
+    async def exited():
+        while p1.poll() is None:
+            await asyncio.sleep(0.2)
+
+    drained = loop.create_task(asyncio.wait(drains))
+    process_exit = loop.create_task(exited())
+    remaining = None if timeout is None else max(0, timeout - time.time())
+    done, pending = await asyncio.wait([drained, process_exit, found],
+                                       timeout=remaining,
+                                       return_when=asyncio.FIRST_COMPLETED)
+    if process_exit in done and found not in done:
+        # the process is gone, give the pipes a moment to reach EOF
+        await asyncio.wait(drains, timeout=1)
+
+    tasks = drains + [drained, process_exit]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return found.done()
+
+def stream_output(p1, stdout_handler, stderr_handler, marker=None, timeout=None):
+    """
+    Drain the stdout and stderr pipes of a process until it exits, passing
+    the complete lines read at once to the handlers. With a marker, return
+    as soon as it is seen on stdout (True) or timeout passes (False).
+    """
+    return asyncio.run(_stream_output(p1, stdout_handler, stderr_handler,
+                                      marker, timeout))
+
 class CIBuilder(Test):
     def setUp(self):
         super(CIBuilder, self).setUp()
@@ -44,7 +116,13 @@ class CIBuilder(Test):
         # needs to run once (per test case)
         if hasattr(self, 'build_dir'):
             self.error("Broken test implementation: init() called multiple times.")
-        self.build_dir = os.path.join(isar_dir, build_dir)
+        # sharded runs (cishard.py) keep the build dirs of each shard apart
+        build_root = self.params.get('build_root', default=None)
+        if build_root:
+            self.build_dir = os.path.join(build_root,
+                                          os.path.basename(os.path.normpath(build_dir)))
+        else:
+            self.build_dir = os.path.join(isar_dir, build_dir)
         os.chdir(isar_dir)
         os.environ["TEMPLATECONF"] = "meta-test/conf"
         path.usable_rw_dir(self.build_dir)
@@ -56,6 +134,7 @@ class CIBuilder(Test):
 
         self.vm_dict = {}
         self.vm_dict_file = '%s/vm_dict_file' % self.build_dir
+        self.vm_env = {}
 
         if os.path.isfile(self.vm_dict_file):
             with open(self.vm_dict_file, "rb") as f:
@@ -71,7 +150,8 @@ class CIBuilder(Test):
                   container=False, ccache=False, sstate=False, offline=False,
                   gpg_pub_key=None, wic_deploy_parts=False, dl_dir=None,
                   sstate_dir=None, ccache_dir=None,
-                  source_date_epoch=None, image_install=None, **kwargs):
+                  source_date_epoch=None, image_install=None, buildstats=False,
+                  **kwargs):
         # write configuration file and set bitbake_args
         # can run multiple times per test case
         self.check_init()
@@ -113,6 +193,7 @@ class CIBuilder(Test):
                       f'  sstate_dir = {sstate_dir}\n'
                       f'  ccache_dir = {ccache_dir}\n'
                       f'  image_install = {image_install}\n'
+                      f'  buildstats = {buildstats}\n'
                       f'===================================================')
 
         # determine bitbake_args
@@ -157,6 +238,8 @@ class CIBuilder(Test):
                 f.write('DL_DIR = "%s"\n' % dl_dir)
             if sstate_dir:
                 f.write('SSTATE_DIR = "%s"\n' % sstate_dir)
+            if buildstats:
+                f.write('USE_BUILDSTATS = "1"\n')
             if image_install is not None:
                 f.write('IMAGE_INSTALL = "%s"' % image_install)
 
@@ -200,18 +283,7 @@ class CIBuilder(Test):
         with subprocess.Popen(" ".join(cmdline), stdout=subprocess.PIPE,
                               stderr=subprocess.PIPE, universal_newlines=True,
                               shell=True) as p1:
-            poller = select.poll()
-            poller.register(p1.stdout, select.POLLIN)
-            poller.register(p1.stderr, select.POLLIN)
-            while p1.poll() is None:
-                events = poller.poll(1000)
-                for fd, event in events:
-                    if event != select.POLLIN:
-                        continue
-                    if fd == p1.stdout.fileno():
-                        self.log.info(p1.stdout.readline().rstrip())
-                    if fd == p1.stderr.fileno():
-                        app_log.error(p1.stderr.readline().rstrip())
+            stream_output(p1, self.log.info, app_log.error)
             p1.wait()
             if p1.returncode:
                 self.fail('Bitbake failed')
@@ -382,8 +454,7 @@ class CIBuilder(Test):
         self.fail('No command to run specified')
 
 
-    def vm_turn_on(self, arch='amd64', distro='buster', image='isar-image-base',
-                   enforce_pcbios=False):
+    def vm_boot_log(self, arch, distro):
         logdir = '%s/vm_start' % self.build_dir
         if not os.path.exists(logdir):
             os.mkdir(logdir)
@@ -391,16 +462,36 @@ class CIBuilder(Test):
                                          distro, arch)
         fd, boot_log = tempfile.mkstemp(suffix='_log.txt', prefix=prefix,
                                            dir=logdir, text=True)
+        os.close(fd)
         os.chmod(boot_log, 0o644)
         latest_link = '%s/vm_start_%s_%s_latest.txt' % (logdir, distro, arch)
         if os.path.exists(latest_link):
             os.unlink(latest_link)
         os.symlink(os.path.basename(boot_log), latest_link)
 
+        return boot_log
+
+
+    def vm_qemu_cmdline(self, arch, distro, image, enforce_pcbios, boot_log,
+                        overlay=None):
+        key = (arch, distro, image)
+        if key not in self.vm_env:
+            self.vm_env[key] = start_vm.get_bitbake_env(arch, distro, image).decode()
+
         cmdline = start_vm.format_qemu_cmdline(arch, self.build_dir, distro, image,
-                                               boot_log, None, enforce_pcbios)
+                                               boot_log, None, enforce_pcbios,
+                                               overlay, self.vm_env[key])
         cmdline.insert(1, '-nographic')
 
+        return cmdline
+
+
+    def vm_turn_on(self, arch='amd64', distro='buster', image='isar-image-base',
+                   enforce_pcbios=False):
+        boot_log = self.vm_boot_log(arch, distro)
+
+        cmdline = self.vm_qemu_cmdline(arch, distro, image, enforce_pcbios, boot_log)
+
         self.log.info('QEMU boot line:\n' + ' '.join(cmdline))
         self.log.info('QEMU boot log:\n' + boot_log)
 
@@ -415,30 +506,198 @@ class CIBuilder(Test):
     def vm_wait_boot(self, p1, timeout):
         login_prompt = b' login:'
 
-        poller = select.poll()
-        poller.register(p1.stdout, select.POLLIN)
-        poller.register(p1.stderr, select.POLLIN)
-
-        while time.time() < timeout and p1.poll() is None:
-            events = poller.poll(1000 * (timeout - time.time()))
-            for fd, event in events:
-                if event != select.POLLIN:
-                    continue
-                if fd == p1.stdout.fileno():
-                    # Wait for the complete string if it is read in chunks
-                    # like "i", "sar", " login:"
-                    time.sleep(0.01)
-                    data = os.read(fd, 1024)
-                    if login_prompt in data:
-                        self.log.info('Got login prompt')
-                        return 0
-                if fd == p1.stderr.fileno():
-                    app_log.error(p1.stderr.readline().rstrip())
+        # the console output is in the boot log already
+        if stream_output(p1, None, app_log.error, login_prompt, timeout):
+            self.log.info('Got login prompt')
+            return 0
 
         self.log.error("Didn't get login prompt")
         return 1
 
 
+    def vm_monitor(self, monitor, command, p1, timeout):
+        # run a command in the human monitor of the VM, return its output
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            while True:
+                try:
+                    sock.connect(monitor)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if p1.poll() is not None or time.time() > timeout:
+                        raise
+                    time.sleep(0.1)
+            sock.settimeout(max(1, timeout - time.time()))
+
+            def read_prompt():
+                data = b''
+                while not data.endswith(b'(qemu) '):
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                return data.decode(errors='replace')
+
+            read_prompt()
+            sock.sendall(command.encode() + b'\n')
+            return read_prompt()
+
+
+    def vm_snapshot_key(self, arch, distro, image, enforce_pcbios):
+        # everything a saved VM state depends on
+        cmdline = self.vm_qemu_cmdline(arch, distro, image, enforce_pcbios,
+                                       'BOOT_LOG', 'OVERLAY')
+        rootfs = start_vm.get_rootfs_image(self.vm_env[(arch, distro, image)],
+                                           arch, distro, image)
+        if not os.path.exists(rootfs):
+            return None
+        st = os.stat(rootfs)
+
+        return {
+            'rootfs': rootfs,
+            'mtime': st.st_mtime_ns,
+            'size': st.st_size,
+            'cmdline': [re.sub(r'hostfwd=tcp::\d+', 'hostfwd=tcp::PORT', arg)
+                        for arg in cmdline],
+        }
+
+
+    def vm_snapshot_valid(self, pool_dir, key):
+        try:
+            with open(pool_dir + '/snapshot.json') as f:
+                return json.load(f) == key
+        except (FileNotFoundError, ValueError):
+            return False
+
+
+    def vm_snapshot_create(self, vm_args, pool_dir, key, time_to_wait):
+        # boot to the login prompt, save the VM state in a qcow2 overlay
+        # of the rootfs image and shut the VM down
+        timeout = time.time() + int(time_to_wait)
+        shutil.rmtree(pool_dir, ignore_errors=True)
+        os.makedirs(pool_dir)
+        overlay = pool_dir + '/disk.qcow2'
+        boot_log = pool_dir + '/boot_log.txt'
+        monitor_dir = tempfile.mkdtemp(prefix='isar-vm-')
+        monitor = monitor_dir + '/monitor.sock'
+
+        p1 = None
+        try:
+            subprocess.run(['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', 'raw',
+                            '-b', key['rootfs'], overlay], check=True)
+            cmdline = self.vm_qemu_cmdline(*vm_args, boot_log, overlay)
+            cmdline[cmdline.index('-monitor') + 1] = 'unix:%s,server,nowait' % monitor
+
+            self.log.info('QEMU snapshot boot line:\n' + ' '.join(cmdline))
+            p1 = subprocess.Popen('exec ' + ' '.join(cmdline), shell=True,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, universal_newlines=True)
+            if self.vm_wait_boot(p1, timeout) != 0:
+                return False
+
+            self.vm_monitor(monitor, 'savevm ' + VM_SNAPSHOT, p1, timeout)
+            if VM_SNAPSHOT not in self.vm_monitor(monitor, 'info snapshots', p1, timeout):
+                self.log.error('Failed to save VM state of ' + pool_dir)
+                return False
+            self.vm_monitor(monitor, 'quit', p1, timeout)
+            p1.wait(max(1, timeout - time.time()))
+
+            with open(pool_dir + '/snapshot.json', 'w') as f:
+                json.dump(key, f)
+            self.log.info('Saved VM state in ' + overlay)
+            return True
+        except (OSError, subprocess.SubprocessError) as e:
+            self.log.error('Failed to create VM snapshot in %s: %s' % (pool_dir, e))
+            return False
+        finally:
+            if p1 and p1.poll() is None:
+                p1.kill()
+                p1.wait()
+            shutil.rmtree(monitor_dir, ignore_errors=True)
+
+
+    def vm_pool_prepare(self, vm_args, time_to_wait):
+        # return the pool dir holding the saved state of the VM, creating it
+        # together with the missing ones of the other VMs in self.vm_pool
+        vm_pool = [vm_args] + [(tuple(v) + (False,))[:4]
+                               for v in getattr(self, 'vm_pool', [])]
+        jobs = {}
+        for args in vm_pool:
+            pool_dir = '%s/vm_pool/%s_%s_%s_%d' % ((self.build_dir,) + args)
+            if pool_dir in jobs:
+                continue
+            key = self.vm_snapshot_key(*args)
+            if key is None:
+                if args == vm_args:
+                    return None
+                continue
+            if self.vm_snapshot_valid(pool_dir, key):
+                if args == vm_args:
+                    return pool_dir
+                continue
+            jobs[pool_dir] = (args, key)
+
+        budget = int(self.params.get('vm_cpu_budget', default=os.cpu_count()))
+        workers = max(1, min(len(jobs), budget // VM_CPUS))
+        self.log.info('Creating %d VM snapshots, %d in parallel' % (len(jobs), workers))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for pool_dir, (args, key) in jobs.items():
+                executor.submit(self.vm_snapshot_create, args, pool_dir, key,
+                                time_to_wait)
+
+        pool_dir, (args, key) = next(iter(jobs.items()))
+        return pool_dir if self.vm_snapshot_valid(pool_dir, key) else None
+
+
+    def vm_restore(self, arch, distro, image, enforce_pcbios, time_to_wait):
+        # start the VM from the state saved at the login prompt
+        pool_dir = self.vm_pool_prepare((arch, distro, image, enforce_pcbios),
+                                        time_to_wait)
+        if pool_dir is None:
+            return None, None, None
+
+        timeout = time.time() + int(time_to_wait)
+        boot_log = self.vm_boot_log(arch, distro)
+        overlay = boot_log[:-len('_log.txt')] + '.qcow2'
+        # the output of the original boot is checked by vm_parse_output
+        shutil.copyfile(pool_dir + '/boot_log.txt', boot_log)
+        subprocess.run(['cp', '--reflink=auto', pool_dir + '/disk.qcow2', overlay],
+                       check=True)
+
+        monitor_dir = tempfile.mkdtemp(prefix='isar-vm-')
+        monitor = monitor_dir + '/monitor.sock'
+        cmdline = self.vm_qemu_cmdline(arch, distro, image, enforce_pcbios,
+                                       boot_log, overlay)
+        cmdline[cmdline.index('-chardev') + 1] += ',logappend=on'
+        cmdline[cmdline.index('-monitor') + 1] = 'unix:%s,server,nowait' % monitor
+        cmdline.extend(['-loadvm', VM_SNAPSHOT])
+
+        self.log.info('QEMU restore line:\n' + ' '.join(cmdline))
+        self.log.info('QEMU boot log:\n' + boot_log)
+
+        p1 = subprocess.Popen('exec ' + ' '.join(cmdline), shell=True,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        try:
+            status = self.vm_monitor(monitor, 'info status', p1, timeout)
+        except OSError:
+            status = ''
+        finally:
+            shutil.rmtree(monitor_dir, ignore_errors=True)
+
+        if 'running' not in status:
+            self.log.error('Failed to restore VM state from ' + pool_dir)
+            if p1.poll() is None:
+                p1.kill()
+            p1.wait()
+            os.unlink(overlay)
+            shutil.rmtree(pool_dir, ignore_errors=True)
+            return None, None, None
+
+        self.log.info("Restored VM with pid %s" % (p1.pid))
+
+        return p1, cmdline, boot_log
+
+
     def vm_parse_output(self, boot_log, bb_output, skip_modulecheck):
         # the printk of recipes-kernel/example-module
         module_output = b'Just an example'
@@ -479,9 +738,14 @@ class CIBuilder(Test):
 
 
     def vm_turn_off(self, vm):
-        pid = self.vm_dict[vm][0]
+        pid, cmdline, boot_log = self.vm_dict[vm]
         os.kill(pid, signal.SIGKILL)
 
+        # overlay of a VM started by vm_restore
+        overlay = boot_log[:-len('_log.txt')] + '.qcow2'
+        if os.path.exists(overlay):
+            os.unlink(overlay)
+
         del(self.vm_dict[vm])
         self.vm_dump_dict(vm)
 
@@ -530,14 +794,22 @@ class CIBuilder(Test):
         if run_qemu:
             self.log.info("No qemu-system process for `%s` found, run new VM" % (vm))
 
-            p1, cmdline, boot_log = self.vm_turn_on(arch, distro, image, enforce_pcbios)
-            self.vm_dict[vm] = p1.pid, cmdline, boot_log
-            self.vm_dump_dict(vm)
+            p1 = None
+            if bool(int(self.params.get('vm_snapshot', default=1))):
+                p1, cmdline, boot_log = self.vm_restore(arch, distro, image,
+                                                        enforce_pcbios, time_to_wait)
+            if p1 is not None:
+                self.vm_dict[vm] = p1.pid, cmdline, boot_log
+                self.vm_dump_dict(vm)
+            else:
+                p1, cmdline, boot_log = self.vm_turn_on(arch, distro, image, enforce_pcbios)
+                self.vm_dict[vm] = p1.pid, cmdline, boot_log
+                self.vm_dump_dict(vm)
 
-            rc = self.vm_wait_boot(p1, timeout)
-            if rc != 0:
-                self.vm_turn_off(vm)
-                self.fail('Failed to boot qemu machine')
+                rc = self.vm_wait_boot(p1, timeout)
+                if rc != 0:
+                    self.vm_turn_off(vm)
+                    self.fail('Failed to boot qemu machine')
 
         if cmd is not None or script is not None:
             self.ssh_user='ci'
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+#
+# Run the Isar testsuite in parallel shards
+#
+# This software is part of Isar
+# Copyright (c) Siemens AG, 2026
+#
+# The tests of a class share their build dir and run in order, so classes are
+# distributed over independent shards, each being a separate avocado job with
+# its own build dirs (-p build_root). All shards share the download dir (and
+# with it DEBDIR) and the sstate cache. Classes are scheduled longest first by
+# the durations recorded in previous runs, preferring the shard which already
+# builds the same multiconfigs, and classes which only boot images follow the
+# class building them. Tests tagged "exclusive" run after all shards.
+
+import argparse
+import ast
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+isar_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+DEF_TEST_DURATION = 600
+# A shard this much busier than the least loaded one (relative to the
+# duration of the class to place) is not considered for target affinity
+AFFINITY_SLACK = 0.5
+
+
+class TestClass:
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.tests = []
+        self.exclusive = []
+        self.builds = set()
+        self.boots = set()
+        self.duration = 0
+
+    @property
+    def multiconfigs(self):
+        return {mc for mc, _ in self.builds | self.boots}
+
+
+class Shard:
+    def __init__(self, num, build_root):
+        self.num = num
+        self.dir = os.path.join(build_root, 'shard-%d' % num)
+        self.classes = []
+        self.load = 0
+
+    @property
+    def multiconfigs(self):
+        return set().union(*(c.multiconfigs for c in self.classes))
+
+    def add(self, cls):
+        self.classes.append(cls)
+        self.load += cls.duration
+
+
+def parse_targets(filename):
+    """Return the (multiconfig, image) pairs built and booted by each class."""
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+
+    targets = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        builds = set()
+        boots = set()
+        for sub in ast.walk(node):
+            if isinstance(sub, ast.Constant) and isinstance(sub.value, str):
+                parts = sub.value.split(':')
+                if parts[0] == 'mc' and len(parts) >= 3:
+                    builds.add((parts[1], parts[2]))
+            elif isinstance(sub, ast.Call) and \
+                    getattr(sub.func, 'attr', None) == 'vm_start':
+                args = [a.value for a in sub.args[:2]
+                        if isinstance(a, ast.Constant)]
+                kwargs = {k.arg: k.value.value for k in sub.keywords
+                          if isinstance(k.value, ast.Constant)}
+                if len(args) == 2:
+                    boots.add(('qemu%s-%s' % tuple(args),
+                               kwargs.get('image', 'isar-image-base')))
+        targets[node.name] = (builds, boots)
+    return targets
+
+
+def list_tests(testfile, tags):
+    cmdline = ['avocado', 'list']
+    for tag in tags:
+        cmdline.extend(['-t', tag])
+    cmdline.append(testfile)
+    output = subprocess.check_output(cmdline, universal_newlines=True)
+    tests = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == 'avocado-instrumented':
+            tests.append(fields[1].rsplit(':', 1)[1])
+    return tests
+
+
+def load_history(history):
+    try:
+        with open(history) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_history(history, durations):
+    tmp = history + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+    os.rename(tmp, history)
+
+
+def collect_classes(testfile, tags, durations):
+    testname = os.path.basename(testfile)
+    targets = parse_targets(testfile)
+    order = list(targets)
+    exclusive = set(list_tests(testfile, [t + ',exclusive' for t in tags]
+                               or ['exclusive']))
+
+    known = [v for v in durations.values() if v > 0]
+    default = sum(known) / len(known) if known else DEF_TEST_DURATION
+
+    classes = {}
+    for test in list_tests(testfile, tags):
+        name = test.split('.')[0]
+        if name not in classes:
+            cls = TestClass(name, order.index(name) if name in order else len(order))
+            cls.builds, cls.boots = targets.get(name, (set(), set()))
+            classes[name] = cls
+        cls = classes[name]
+        if test in exclusive:
+            cls.exclusive.append(test)
+        else:
+            cls.tests.append(test)
+            cls.duration += durations.get('%s:%s' % (testname, test), default)
+    return list(classes.values())
+
+
+def schedule(classes, shards):
+    # classes only booting images go along with the class building most of
+    # them and are scheduled together with it
+    consumers = [c for c in classes if c.boots and not c.builds]
+    producers = [c for c in classes if c not in consumers]
+    groups = {c.name: [c] for c in producers}
+    for cls in consumers:
+        producer = max(producers, key=lambda c: len(c.builds & cls.boots),
+                       default=None)
+        if producer and producer.builds & cls.boots:
+            groups[producer.name].append(cls)
+        else:
+            groups[cls.name] = [cls]
+
+    def duration(group):
+        return sum(c.duration for c in group)
+
+    def multiconfigs(group):
+        return set().union(*(c.multiconfigs for c in group))
+
+    for group in sorted(groups.values(), key=duration, reverse=True):
+        least = min(s.load for s in shards)
+        candidates = [s for s in shards
+                      if s.load <= least + AFFINITY_SLACK * duration(group)]
+        shard = max(candidates, key=lambda s: (len(s.multiconfigs & multiconfigs(group)),
+                                               -s.load))
+        for cls in group:
+            shard.add(cls)
+
+    for shard in shards:
+        shard.classes.sort(key=lambda c: c.index)
+
+
+def avocado_cmdline(shard, testfile, tests, extra_args):
+    cmdline = ['avocado', 'run', '--max-parallel-tasks=1',
+               '--job-results-dir', os.path.join(shard.dir, 'job-results'),
+               '-p', 'build_root=%s' % shard.dir]
+    cmdline.extend(extra_args)
+    # references are regular expressions on the test names
+    cmdline.extend('%s:%s$' % (testfile, re.escape(t)) for t in tests)
+    return cmdline
+
+
+def run_shards(jobs, log_name):
+    """Run (shard, cmdline) jobs in parallel, return the failed shards."""
+    procs = []
+    for shard, cmdline in jobs:
+        os.makedirs(shard.dir, exist_ok=True)
+        log = open(os.path.join(shard.dir, log_name), 'w')
+        print('shard-%d: %s' % (shard.num, ' '.join(cmdline)))
+        procs.append((shard, subprocess.Popen(cmdline, stdout=log,
+                                              stderr=subprocess.STDOUT),
+                      log, time.time()))
+
+    failed = []
+    for shard, proc, log, start in procs:
+        rc = proc.wait()
+        log.close()
+        print('shard-%d: %s after %ds, log: %s' %
+              (shard.num, 'passed' if rc == 0 else 'FAILED (%d)' % rc,
+               time.time() - start, log.name))
+        if rc != 0:
+            failed.append(shard)
+    return failed
+
+
+def record_durations(shards, testname, durations):
+    for shard in shards:
+        results = os.path.join(shard.dir, 'job-results', 'latest', 'results.json')
+        try:
+            with open(results) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        for test in data.get('tests', []):
+            if test.get('status') in ('SKIP', 'CANCEL') or not test.get('time'):
+                continue
+            name = test['name'].rsplit(':', 1)[1].rstrip('$').replace('\\', '')
+            durations['%s:%s' % (testname, name)] = round(test['time'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the Isar testsuite in parallel shards. Unknown '
+                    'arguments are passed to "avocado run".')
+    parser.add_argument('-t', '--tags', action='append', default=[],
+                        help='avocado tags to select the tests.')
+    parser.add_argument('-j', '--shards', type=int,
+                        default=max(1, (os.cpu_count() or 1) // 16),
+                        help='number of shards to run in parallel.')
+    parser.add_argument('-b', '--build-root', default=isar_root,
+                        help='directory for the shard build dirs.')
+    parser.add_argument('--history',
+                        help='test durations of previous runs, default: '
+                             'BUILD_ROOT/ci-durations.json.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the schedule without running tests.')
+    parser.add_argument('--testfile',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'citest.py'),
+                        help='file containing the tests.')
+    args, extra_args = parser.parse_known_args()
+
+    build_root = os.path.abspath(args.build_root)
+    history = args.history or os.path.join(build_root, 'ci-durations.json')
+    testname = os.path.basename(args.testfile)
+    durations = load_history(history)
+
+    classes = collect_classes(args.testfile, args.tags, durations)
+    if not classes:
+        print('No tests selected')
+        return 0
+
+    shards = [Shard(n, build_root) for n in range(min(args.shards, len(classes)))]
+    schedule(classes, shards)
+
+    for shard in shards:
+        print('shard-%d (~%dm): %s' % (shard.num, shard.load / 60,
+                                        ' '.join(c.name for c in shard.classes)))
+    exclusive = [(s, [t for c in s.classes for t in c.exclusive]) for s in shards]
+    exclusive = [(s, tests) for s, tests in exclusive if tests]
+    for shard, tests in exclusive:
+        print('shard-%d (exclusive): %s' % (shard.num, ' '.join(tests)))
+    if args.dry_run:
+        return 0
+
+    os.environ.setdefault('DL_DIR', os.path.join(isar_root, 'downloads'))
+    os.environ.setdefault('SSTATE_DIR', os.path.join(isar_root, 'sstate-cache'))
+
+    jobs = [(s, avocado_cmdline(s, args.testfile,
+                                [t for c in s.classes for t in c.tests],
+                                extra_args))
+            for s in shards if any(c.tests for c in s.classes)]
+    failed = run_shards(jobs, 'avocado.log')
+    record_durations([s for s, _ in jobs], testname, durations)
+
+    for shard, tests in exclusive:
+        failed += run_shards([(shard, avocado_cmdline(shard, args.testfile,
+                                                      tests, extra_args))],
+                             'avocado-exclusive.log')
+        record_durations([shard], testname, durations)
+
+    os.makedirs(build_root, exist_ok=True)
+    save_history(history, durations)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
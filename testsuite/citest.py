@@ -45,6 +45,12 @@ class DevTest(CIBaseTest):
         self.perform_build_test(targets)
 
     def test_dev_rebuild(self):
+        """
+        Modifies a class of the core layer, which must not happen while
+        other builds run on the same layers.
+
+        :avocado: tags=exclusive
+        """
         self.init()
         layerdir_core = self.getlayerdir('core')
 
@@ -323,6 +329,12 @@ class VmBootTestFast(CIBaseTest):
     :avocado: tags=startvm,fast
     """
 
+    vm_pool = [
+        ('arm', 'bullseye', 'isar-image-ci'),
+        ('arm', 'buster', 'isar-image-ci'),
+        ('arm', 'bookworm', 'isar-image-ci'),
+              ]
+
     def test_arm_bullseye(self):
         self.init()
         self.vm_start('arm','bullseye', image='isar-image-ci')
@@ -379,6 +391,20 @@ class VmBootTestFull(CIBaseTest):
     :avocado: tags=startvm,full
     """
 
+    vm_pool = [
+        ('arm', 'bullseye', 'isar-image-base'),
+        ('arm', 'buster', 'isar-image-ci'),
+        ('arm64', 'bullseye', 'isar-image-ci'),
+        ('i386', 'buster', 'isar-image-base'),
+        ('amd64', 'buster', 'isar-image-ci'),
+        ('amd64', 'buster', 'isar-image-ci', True),
+        ('amd64', 'focal', 'isar-image-ci'),
+        ('amd64', 'bookworm', 'isar-image-ci'),
+        ('arm', 'bookworm', 'isar-image-ci'),
+        ('i386', 'bookworm', 'isar-image-base'),
+        ('mipsel', 'bookworm', 'isar-image-ci'),
+              ]
+
     def test_arm_bullseye(self):
         self.init()
         self.vm_start('arm','bullseye',
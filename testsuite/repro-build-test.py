@@ -2,6 +2,7 @@
 
 from cibuilder import CIBuilder
 from avocado.utils import process
+from repro_compare import compare_images
 
 
 class ReproBuild(CIBuilder):
@@ -68,12 +69,10 @@ class ReproBuild(CIBuilder):
         self.log.info(
             "Compare artifacts image1: " + image1 + ", image2: " + image2
         )
-        result = process.run(
-            "diffoscope "
-            "--text " + self.build_dir + "/diffoscope-output.txt"
-            " " + self.build_dir + "/" + image1 +
-            " " + self.build_dir + "/" + image2,
-            ignore_status=True,
-        )
-        if result.exit_status > 0:
+        if not compare_images(
+            self.build_dir + "/" + image1,
+            self.build_dir + "/" + image2,
+            self.build_dir,
+            self.log,
+        ):
             self.fail(f"Images {image1} and {image2} are not reproducible")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Compare two image artifacts for reproducibility
+#
+# This software is part of Isar
+# Copyright (c) Siemens AG, 2026
+#
+# diffoscope takes very long on complete images. Identical images are
+# detected by hashing both in parallel chunks. For differing tar images, the
+# members are listed with their metadata and content digest in one pass over
+# each archive and only the members with differing content are extracted and
+# passed to diffoscope. Other images are passed to diffoscope as a whole.
+
+import argparse
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+
+CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def chunk_digest(path, offset):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = CHUNK_SIZE
+        while remaining:
+            data = f.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            h.update(data)
+            remaining -= len(data)
+    return h.digest()
+
+
+def identical(path1, path2, jobs=None):
+    size = os.path.getsize(path1)
+    if size != os.path.getsize(path2):
+        return False
+
+    offsets = range(0, size, CHUNK_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        digests1 = executor.map(chunk_digest, [path1] * len(offsets), offsets)
+        digests2 = executor.map(chunk_digest, [path2] * len(offsets), offsets)
+        return list(digests1) == list(digests2)
+
+
+def tar_manifest(path):
+    """Map member names to their metadata and content digest, in order."""
+    manifest = {}
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            entry = {
+                'type': member.type.decode(),
+                'mode': member.mode,
+                'uid': member.uid,
+                'gid': member.gid,
+                'uname': member.uname,
+                'gname': member.gname,
+                'mtime': member.mtime,
+                'linkname': member.linkname,
+                'size': member.size,
+                'xattrs': {k: v for k, v in member.pax_headers.items()
+                           if k.startswith('SCHILY.')},
+            }
+            if member.isfile():
+                h = hashlib.sha256()
+                f = tar.extractfile(member)
+                for data in iter(lambda: f.read(READ_SIZE), b''):
+                    h.update(data)
+                entry['sha256'] = h.hexdigest()
+            manifest[member.name] = entry
+    return manifest
+
+
+def extract_members(path, names, dest):
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            if member.name not in names:
+                continue
+            target = os.path.join(dest, os.path.normpath(member.name).lstrip('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+
+
+def diffoscope(path1, path2, output, log):
+    log.info('Running diffoscope on %s and %s' % (path1, path2))
+    proc = subprocess.run(['diffoscope', '--text', output, path1, path2])
+    return proc.returncode == 0
+
+
+def compare_images(image1, image2, workdir, log=logging.getLogger(__name__)):
+    """
+    Return True if image1 and image2 are identical, otherwise log the
+    differences and write the diffoscope output to workdir.
+    """
+    if identical(image1, image2):
+        log.info('Images %s and %s are identical' % (image1, image2))
+        return True
+
+    output = os.path.join(workdir, 'diffoscope-output.txt')
+    if not (tarfile.is_tarfile(image1) and tarfile.is_tarfile(image2)):
+        return diffoscope(image1, image2, output, log)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        manifest1, manifest2 = executor.map(tar_manifest, [image1, image2])
+
+    for name in sorted(manifest1.keys() - manifest2.keys()):
+        log.error('Only in %s: %s' % (image1, name))
+    for name in sorted(manifest2.keys() - manifest1.keys()):
+        log.error('Only in %s: %s' % (image2, name))
+
+    content = []
+    for name in manifest1.keys() & manifest2.keys():
+        entry1 = manifest1[name]
+        entry2 = manifest2[name]
+        for key in sorted(entry1.keys() | entry2.keys()):
+            if entry1.get(key) != entry2.get(key):
+                if key == 'sha256':
+                    content.append(name)
+                else:
+                    log.error('%s: %s differs: %s != %s' %
+                              (name, key, entry1.get(key), entry2.get(key)))
+
+    if manifest1 == manifest2:
+        if list(manifest1) != list(manifest2):
+            log.error('Members are stored in a different order')
+        # only the archive or compression format can differ
+        return diffoscope(image1, image2, output, log)
+
+    if content:
+        log.error('Content differs: %s' % ' '.join(sorted(content)))
+        members = os.path.join(workdir, 'repro-members')
+        shutil.rmtree(members, ignore_errors=True)
+        dirs = [os.path.join(members, 'a'), os.path.join(members, 'b')]
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            list(executor.map(extract_members, [image1, image2],
+                              [set(content)] * 2, dirs))
+        diffoscope(dirs[0], dirs[1], output, log)
+
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare two images for reproducibility.')
+    parser.add_argument('image1')
+    parser.add_argument('image2')
+    parser.add_argument('-w', '--workdir', default=os.getcwd(),
+                        help='directory for the diffoscope output.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sys.exit(0 if compare_images(args.image1, args.image2, args.workdir) else 1)
@@ -22,17 +22,46 @@ def get_bitbake_var(output, var):
             ret = line.split('"')[1]
     return ret
 
-def format_qemu_cmdline(arch, build, distro, image, out, pid, enforce_pcbios=False):
-    bb_output = get_bitbake_env(arch, distro, image).decode()
+def get_rootfs_image(bb_output, arch, distro, image):
+    image_type = get_bitbake_var(bb_output, 'IMAGE_FSTYPES').split()[0]
+    deploy_dir_image = get_bitbake_var(bb_output, 'DEPLOY_DIR_IMAGE')
+    base = 'ubuntu' if distro in ['focal', 'bionic'] else 'debian'
+
+    return deploy_dir_image + '/' + image + '-' + base + '-' + distro + '-qemu' + arch + '.' + image_type
+
+def overlay_disk_args(disk_args, overlay):
+    # Boot the qcow2 overlay instead of the raw rootfs image: set the format
+    # of the -drive holding ##ROOTFS_IMAGE##, turn -hda into such a -drive
+    args = disk_args.split()
+    for i, arg in enumerate(args[:-1]):
+        if '##ROOTFS_IMAGE##' not in args[i + 1]:
+            continue
+        if arg == '-hda':
+            args[i] = '-drive'
+            args[i + 1] = 'file=' + args[i + 1] + ',index=0,media=disk'
+        if args[i] == '-drive':
+            options = [o for o in args[i + 1].split(',')
+                       if not o.startswith('format=')]
+            args[i + 1] = ','.join(options + ['format=qcow2'])
+
+    disk_args = ' '.join(args)
+    for arg in args:
+        if '##ROOTFS_IMAGE##' in arg and 'format=qcow2' not in arg.split(','):
+            raise ValueError('Cannot boot overlay with disk args: ' + disk_args)
+    return disk_args.replace('##ROOTFS_IMAGE##', overlay)
+
+def format_qemu_cmdline(arch, build, distro, image, out, pid, enforce_pcbios=False,
+                        overlay=None, bb_output=None):
+    # overlay: qcow2 image backed by the rootfs image to boot instead of it
+    if bb_output is None:
+        bb_output = get_bitbake_env(arch, distro, image).decode()
 
     extra_args = ''
     cpu = ['']
 
     image_type = get_bitbake_var(bb_output, 'IMAGE_FSTYPES').split()[0]
     deploy_dir_image = get_bitbake_var(bb_output, 'DEPLOY_DIR_IMAGE')
-    base = 'ubuntu' if distro in ['focal', 'bionic'] else 'debian'
-
-    rootfs_image = image + '-' + base + '-' + distro + '-qemu' + arch + '.' + image_type
+    rootfs_image = get_rootfs_image(bb_output, arch, distro, image)
 
     if image_type == 'ext4':
         kernel_image = deploy_dir_image + '/' + get_bitbake_var(bb_output, 'KERNEL_IMAGE')
@@ -50,7 +79,7 @@ def format_qemu_cmdline(arch, build, distro, image, out, pid, enforce_pcbios=Fal
         extra_args = ['-kernel', kernel_image, '-initrd', initrd_image]
         extra_args.extend(kargs)
     elif image_type == 'wic':
-        extra_args = ['-snapshot']
+        extra_args = [] if overlay else ['-snapshot']
     else:
         raise ValueError('Invalid image type: ' + str(image_type))
 
@@ -66,7 +95,9 @@ def format_qemu_cmdline(arch, build, distro, image, out, pid, enforce_pcbios=Fal
     if pid:
         extra_args.extend(['-pidfile', pid])
 
-    qemu_disk_args = qemu_disk_args.replace('##ROOTFS_IMAGE##', deploy_dir_image + '/' + rootfs_image).split()
+    if overlay:
+        qemu_disk_args = overlay_disk_args(qemu_disk_args, overlay)
+    qemu_disk_args = qemu_disk_args.replace('##ROOTFS_IMAGE##', rootfs_image).split()
     if enforce_pcbios and '-bios' in qemu_disk_args:
         bios_idx = qemu_disk_args.index('-bios')
         del qemu_disk_args[bios_idx : bios_idx+2]